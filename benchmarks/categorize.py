@@ -0,0 +1,83 @@
+"""
+Benchmark merchant categorisation throughput as the number of rules grows.
+
+Compares checking every rule in turn (substring, prefix and regex tests) with
+the compiled Categorizer, with its LRU cache disabled so every row is matched.
+
+    python benchmarks/categorize.py --rows 20000 --rules 10 100 1000 10000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailmint.categories import Categorizer, DEFAULT_CATEGORY, normalise_merchant
+
+WORDS = ["fresh", "mart", "fuel", "pharma", "foods", "travels", "stores", "cafe", "digital", "mobile"]
+
+
+def make_rules(n, rnd):
+    rules = []
+    for i in range(n):
+        kind = rnd.choice(["contains", "contains", "prefix", "regex"])
+        literal = f"shop{i} {rnd.choice(WORDS)}"
+        pattern = rf"^brand{i}\b" if kind == "regex" else literal
+        rules.append({"category": f"Category {i % 50}", kind: [pattern]})
+    return rules
+
+
+def make_merchants(rows, n_rules, rnd):
+    merchants = []
+    for _ in range(rows):
+        i = rnd.randrange(n_rules * 2)  # about half match no rule
+        merchants.append(f"{rnd.choice(['', 'UPI-'])}SHOP{i} {rnd.choice(WORDS).upper()} BANGALORE IN"
+                         if rnd.random() < 0.8 else f"BRAND{i} ONLINE")
+    return merchants
+
+
+def legacy_categorize(rules):
+    compiled = [(rule, [re.compile(p, re.IGNORECASE) for p in rule.get("regex", [])]) for rule in rules]
+
+    def categorize(merchant):
+        merchant = normalise_merchant(merchant)
+        for rule, regexes in compiled:
+            if (any(p in merchant for p in rule.get("contains", []))
+                    or any(merchant.startswith(p) for p in rule.get("prefix", []))
+                    or any(r.search(merchant) for r in regexes)):
+                return rule["category"]
+        return DEFAULT_CATEGORY
+    return categorize
+
+
+def measure(fn, merchants):
+    start = time.perf_counter()
+    results = [fn(m) for m in merchants]
+    return len(merchants) / (time.perf_counter() - start), results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--rows", type=int, default=20000)
+    ap.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    print(f"{'rules':>8} {'before rows/s':>14} {'after rows/s':>14} {'speedup':>8}")
+    for n in args.rules:
+        rnd = random.Random(args.seed)
+        rules = make_rules(n, rnd)
+        merchants = make_merchants(args.rows, n, rnd)
+        # the legacy loop gets slow with many rules, time it on a sample
+        before, expected = measure(legacy_categorize(rules), merchants[:max(200, args.rows * 10 // n)])
+        after, actual = measure(Categorizer(rules, cache_size=0), merchants)
+        if actual[:len(expected)] != expected:
+            sys.exit(f"Categorizer disagrees with the rule-by-rule loop for {n} rules")
+        print(f"{n:>8} {before:>14,.0f} {after:>14,.0f} {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""
+Local stand-in for the subset of the Gmail v1 and Sheets v4 REST APIs mailmint
+uses, backed by a synthetic mailbox, so performance can be measured without
+touching real Google quotas.
+
+Gmail: profile, history.list, messages.list, messages.get, watch and the /batch endpoint.
+Sheets: spreadsheets.get/batchUpdate and values batchGet/batchUpdate/clear/update.
+
+Point clients at it with `root_url=server.url` and anonymous credentials:
+
+    with FakeGoogleServer(SyntheticMailbox(10000)) as server:
+        gmail = GMail(credentials=AnonymousCredentials(), root_url=server.url)
+"""
+import base64
+import email
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailmint.google.query import GmailQueryMatcher
+
+MERCHANTS = ["AMAZON", "SWIGGY", "ZOMATO LIMITED", "UBER INDIA", "BIGBASKET", "IRCTC", "APOLLO PHARMACY", "SHELL FUEL"]
+FILLER = "<p>This is a system generated alert. Please do not reply to this email. For queries call our helpline.</p>"
+
+# message templates modelled on the README examples; issuer k uses TEMPLATES[k % 3]
+TEMPLATES = [
+    {
+        "name": "Lender Bank Credit Card",
+        "sender": "alerts@abcbank{k}.com",
+        "subject": "ABC Bank Credit Card Transaction Alert",
+        "patterns": [{
+            "pattern": r"INR (?P<amount>[0-9,]+\.\d{2}) were spent on your .* xx(?P<account>\d{4}) at (?P<merchant>.*) on ",
+            "direction": -1,
+        }],
+        "alert": "Dear Customer, INR {amount} were spent on your ABC Bank Credit Card xx{account} at {merchant} on {date}. ",
+    },
+    {
+        "name": "WallStreet Bank Account",
+        "sender": "online@wsbank{k}.com",
+        "subject": "Transaction Alert from WS Bank",
+        "patterns": [
+            {"pattern": r"Rs\.\s*(?P<amount>[0-9,]+\.\d{2}) deducted from .*XX(?P<account>\d{4}) by (?P<merchant>.*) on ", "direction": -1},
+            {"pattern": r"Rs\.\s*(?P<amount>[0-9,]+\.\d{2}) credited to .*XX(?P<account>\d{4}) for (?P<merchant>.*) on ", "direction": 1},
+        ],
+        "alert": "Rs. {amount} deducted from your account XX{account} by {merchant} on {date}. ",
+    },
+    {
+        "name": "HDFC Bank Account",
+        "sender": "alerts@hdfcbank{k}.net",
+        "subject": "You have done a UPI txn. Check details!",
+        "parser_class": "mailmint.issuers.hdfc.HDFCBankParser",
+        "alert": "Dear Customer,<br>Rs.{amount} has been debited from account **{account} to VPA pay{account}@upi {merchant} on {date}.<br>",
+    },
+]
+
+UNRELATED = {"sender": "newsletter@shop.example", "subject": "Weekly deals"}
+
+
+def make_issuers(n):
+    """Issuer configs (as in config.yml) for n synthetic issuers."""
+    issuers = []
+    for k in range(n):
+        tpl = TEMPLATES[k % len(TEMPLATES)]
+        issuer = {
+            "name": tpl["name"] if k < len(TEMPLATES) else f"{tpl['name']} {k}",
+            "email_query": f'from:{tpl["sender"].format(k=k)} subject:"{tpl["subject"]}"',
+        }
+        if "patterns" in tpl:
+            issuer["patterns"] = tpl["patterns"]
+        if "parser_class" in tpl:
+            issuer["parser_class"] = tpl["parser_class"]
+        issuers.append(issuer)
+    return issuers
+
+
+class SyntheticMailbox:
+    """
+    Deterministic mailbox of `size` messages spread over the last `days` days.
+
+    Each message belongs to one of `issuers` synthetic issuers (weighted by `mix`)
+    or is unrelated mail; `noise` is the fraction of an issuer's messages that are
+    promotional mail from the same sender, without transaction keywords. Message
+    contents are generated on request from the id, so 1M-message mailboxes only
+    cost a few MB.
+    """
+
+    def __init__(self, size, issuers=3, mix=None, noise=0.2, unrelated=0.1, days=60, seed=0,
+                 address="bench@example.com"):
+        self.size = size
+        self.address = address
+        self.issuers = make_issuers(issuers)
+        self.noise = noise
+        self.seed = seed
+        self.now = datetime(2025, 3, 1)
+        self.days = days
+        weights = list(mix or [1] * issuers)
+        rnd = random.Random(seed)
+        # owner per message id: issuer index, or -1 for unrelated mail
+        choices = list(range(issuers)) + [-1]
+        weights = [w * (1 - unrelated) / sum(weights) for w in weights] + [unrelated]
+        self.owner = rnd.choices(choices, weights=weights, k=size)
+        self.by_owner = {}
+        for mid, owner in enumerate(self.owner):
+            self.by_owner.setdefault(owner, []).append(mid)
+
+    def message_id(self, index):
+        return f"{index:016x}"
+
+    def headers_of(self, owner):
+        if owner < 0:
+            return UNRELATED["sender"], UNRELATED["subject"]
+        tpl = TEMPLATES[owner % len(TEMPLATES)]
+        return tpl["sender"].format(k=owner), tpl["subject"]
+
+    def sent_at(self, index):
+        return self.now - timedelta(days=self.days * (self.size - index) / self.size)
+
+    def list_ids(self, query):
+        """Message ids matching a Gmail query, newest first like Gmail."""
+        bounds = {}
+        for op, value in re.findall(r"\b(after|before):(\S+)", query):
+            bounds[op] = datetime.fromtimestamp(int(value)) if value.isdigit() else datetime.strptime(value, "%Y/%m/%d")
+        query = re.sub(r"\s*\b(after|before|in):\S+", "", query).strip()
+        if query.startswith("((") and query.endswith("))"):
+            queries = query[2:-2].split(") OR (")
+        else:
+            queries = [query]
+        matchers = [GmailQueryMatcher(q) for q in queries]
+
+        owners = []
+        for owner in self.by_owner:
+            sender, subject = self.headers_of(owner)
+            headers = {"from": sender, "subject": subject}
+            if any(m.matches(headers) for m in matchers):
+                owners.append(owner)
+        ids = sorted((mid for owner in owners for mid in self.by_owner[owner]), reverse=True)
+        if bounds:
+            after, before = bounds.get("after", datetime.min), bounds.get("before", datetime.max)
+            ids = [mid for mid in ids if after <= self.sent_at(mid) < before]
+        return [self.message_id(mid) for mid in ids]
+
+    def message(self, message_id, fmt="full"):
+        index = int(message_id, 16)
+        if not 0 <= index < self.size:
+            return None
+        rnd = random.Random(self.seed * 1_000_003 + index)
+        owner = self.owner[index]
+        sender, subject = self.headers_of(owner)
+        sent = self.sent_at(index)
+        if owner >= 0 and rnd.random() >= self.noise:
+            tpl = TEMPLATES[owner % len(TEMPLATES)]
+            alert = tpl["alert"].format(
+                amount=f"{rnd.randint(1, 50000):,}.{rnd.randint(0, 99):02d}",
+                account=rnd.randint(1000, 9999),
+                merchant=rnd.choice(MERCHANTS),
+                date=sent.strftime("%d-%m-%y"),
+            )
+        else:
+            alert = "Exclusive offers selected just for you. Upgrade your card today!"
+        html = "<html><body>" + FILLER * rnd.randint(2, 10) + alert + FILLER * rnd.randint(2, 10) + "</body></html>"
+
+        headers = [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": self.address},
+            {"name": "Subject", "value": subject},
+            {"name": "Date", "value": sent.strftime("%a, %d %b %Y %H:%M:%S +0530")},
+            {"name": "Message-ID", "value": f"<{message_id}.{owner}@mail.example>"},
+            {"name": "Content-Type", "value": "text/html; charset=utf-8"},
+        ]
+        msg = {
+            "id": message_id,
+            "threadId": message_id,
+            "internalDate": str(int(sent.timestamp() * 1000)),
+            "snippet": re.sub(r"<[^>]+>", " ", alert)[:200],
+            "sizeEstimate": len(html),
+            "payload": {"mimeType": "text/html", "headers": headers},
+        }
+        if fmt == "full":
+            msg["payload"]["body"] = {"size": len(html), "data": base64.urlsafe_b64encode(html.encode()).decode()}
+        elif fmt == "minimal":
+            del msg["payload"]
+        return msg
+
+
+def _parse_range(a1):
+    """'2025-01'!A2:E -> ("2025-01", 2)"""
+    sheet, _, cells = a1.rpartition("!")
+    if sheet.startswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+    row = re.search(r"\d+", cells.split(":")[0])
+    return sheet, int(row.group()) if row else 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        fake.count("http_requests")
+        fake.count("bytes_received", len(body))
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        url = urlsplit(self.path)
+        if url.path == "/batch":
+            status, payload, ctype = fake.batch(self.headers.get("Content-Type"), body)
+            fake.count("bytes_sent", len(payload))
+            return self._respond(status, payload, ctype)
+
+        status, payload = fake.dispatch(self.command, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode()
+        fake.count("bytes_sent", len(data))
+        self._respond(status, data)
+
+    do_GET = do_POST = do_PUT = _handle
+
+
+class FakeGoogleServer:
+    """
+    Threaded local HTTP server speaking the Gmail/Sheets subset, with injectable
+    per-request `latency` (seconds) and `rate_limit` (fraction of messages.get
+    calls answered with 429 rateLimitExceeded). `calls` counts requests per API
+    method; spreadsheets are created on first access with a "Template" sheet.
+    """
+
+    def __init__(self, mailbox, latency=0.0, rate_limit=0.0, seed=0, host="127.0.0.1", port=0):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.spreadsheets = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.calls[key] += n
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+    def push(self, url, history_id=None):
+        """POST a Gmail watch notification for the mailbox to `url` the way a Pub/Sub push subscription does."""
+        data = json.dumps({"emailAddress": self.mailbox.address, "historyId": history_id or self.mailbox.size})
+        body = json.dumps({"message": {"data": base64.b64encode(data.encode()).decode(), "messageId": "1"},
+                           "subscription": "projects/fake/subscriptions/gmail"}).encode()
+        request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return response.status
+
+    # -- Gmail -------------------------------------------------------------
+
+    def batch(self, content_type, body):
+        self.count("gmail.batch")
+        request = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{self.random.getrandbits(64):016x}"
+        parts = []
+        for part in request.get_payload():
+            request_line = part.get_payload().split("\n", 1)[0].strip()
+            method, target, _ = request_line.split(" ", 2)
+            url = urlsplit(target)
+            status, payload = self.dispatch(method, url.path, parse_qs(url.query), b"")
+            reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests"}.get(status, "Error")
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        data = ("".join(parts) + f"--{boundary}--\r\n").encode()
+        return 200, data, f"multipart/mixed; boundary={boundary}"
+
+    def dispatch(self, method, path, params, body):
+        path = unquote(path)
+        m = re.fullmatch(r"/gmail/v1/users/me/(profile|history|messages|watch)(?:/([^/]+))?", path)
+        if m:
+            return self.gmail(m.group(1), m.group(2), {k: v[-1] for k, v in params.items()})
+        m = re.fullmatch(r"/v4/spreadsheets/([^/:]+)(?::(batchUpdate))?(?:/values(?::(batchGet|batchUpdate)|/(.+?)(:clear)?))?", path)
+        if m:
+            return self.sheets(method, m, params, json.loads(body) if body else {})
+        return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+    def gmail(self, resource, message_id, params):
+        mailbox = self.mailbox
+        if resource == "profile":
+            self.count("gmail.getProfile")
+            return 200, {"emailAddress": mailbox.address, "historyId": str(mailbox.size), "messagesTotal": mailbox.size}
+        if resource == "watch":
+            self.count("gmail.watch")
+            return 200, {"historyId": str(mailbox.size), "expiration": str(int((time.time() + 7 * 86400) * 1000))}
+        if resource == "history":
+            self.count("gmail.history.list")
+            return 200, {"history": [], "historyId": str(mailbox.size)}
+        if message_id is None:
+            self.count("gmail.messages.list")
+            ids = mailbox.list_ids(params.get("q", ""))
+            offset = int(params.get("pageToken") or 0)
+            page = int(params.get("maxResults") or 100)
+            result = {"messages": [{"id": mid, "threadId": mid} for mid in ids[offset:offset + page]],
+                      "resultSizeEstimate": len(ids)}
+            if offset + page < len(ids):
+                result["nextPageToken"] = str(offset + page)
+            return 200, result
+
+        self.count("gmail.messages.get")
+        with self.lock:
+            limited = self.rate_limit and self.random.random() < self.rate_limit
+        if limited:
+            self.count("gmail.messages.get.429")
+            return 429, {"error": {"code": 429, "message": "User-rate limit exceeded (rateLimitExceeded)",
+                                   "errors": [{"reason": "rateLimitExceeded", "domain": "usageLimits"}]}}
+        msg = mailbox.message(message_id, params.get("format", "full"))
+        if msg is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        return 200, msg
+
+    # -- Sheets ------------------------------------------------------------
+
+    def _spreadsheet(self, spreadsheet_id):
+        with self.lock:
+            if spreadsheet_id not in self.spreadsheets:
+                self.spreadsheets[spreadsheet_id] = {"Template": {"sheetId": 0, "rows": [["Date", "Amount", "Merchant", "Account", "Category"]]}}
+            return self.spreadsheets[spreadsheet_id]
+
+    def _write(self, sheets, a1, values):
+        name, row = _parse_range(a1)
+        rows = sheets[name]["rows"]
+        for i, values_row in enumerate(values):
+            idx = row - 1 + i
+            while len(rows) <= idx:
+                rows.append([])
+            rows[idx] = list(values_row)
+
+    def sheets(self, method, m, params, body):
+        spreadsheet_id, sheet_op, values_op, a1, clear = m.groups()
+        sheets = self._spreadsheet(spreadsheet_id)
+        if sheet_op == "batchUpdate":
+            self.count("sheets.spreadsheets.batchUpdate")
+            for req in body.get("requests", []):
+                dup = req.get("duplicateSheet")
+                if dup:
+                    source = next(s for s in sheets.values() if s["sheetId"] == dup["sourceSheetId"])
+                    sheets[dup["newSheetName"]] = {"sheetId": len(sheets), "rows": [list(r) for r in source["rows"]]}
+            return 200, {"spreadsheetId": spreadsheet_id, "replies": [{} for _ in body.get("requests", [])]}
+        if values_op == "batchGet":
+            self.count("sheets.values.batchGet")
+            ranges = []
+            for a1 in params.get("ranges", []):
+                name, row = _parse_range(a1)
+                rows = [list(r) for r in sheets[name]["rows"][row - 1:]]
+                for r in rows:
+                    while r and r[-1] in ("", None):
+                        r.pop()
+                while rows and not rows[-1]:
+                    rows.pop()
+                ranges.append({"range": a1, "values": rows} if rows else {"range": a1})
+            return 200, {"spreadsheetId": spreadsheet_id, "valueRanges": ranges}
+        if values_op == "batchUpdate":
+            self.count("sheets.values.batchUpdate")
+            for vr in body.get("data", []):
+                self._write(sheets, vr["range"], vr["values"])
+            return 200, {"spreadsheetId": spreadsheet_id, "totalUpdatedRows": sum(len(vr["values"]) for vr in body.get("data", []))}
+        if a1 and clear:
+            self.count("sheets.values.clear")
+            name, row = _parse_range(a1)
+            del sheets[name]["rows"][row - 1:]
+            return 200, {"spreadsheetId": spreadsheet_id, "clearedRange": a1}
+        if a1 and method == "PUT":
+            self.count("sheets.values.update")
+            self._write(sheets, a1, body.get("values", []))
+            return 200, {"spreadsheetId": spreadsheet_id, "updatedRows": len(body.get("values", []))}
+        self.count("sheets.spreadsheets.get")
+        return 200, {"spreadsheetId": spreadsheet_id, "sheets": [
+            {"properties": {"sheetId": s["sheetId"], "title": title}} for title, s in sheets.items()
+        ]}
@@ -0,0 +1,157 @@
+"""
+End-to-end benchmark against a local fake Gmail/Sheets server (fakegoogle.py).
+
+Runs the real GMail and GSheet clients over HTTP against a synthetic mailbox:
+list + batch-fetch every issuer's messages, parse them, then write the month
+sheets twice (the second write should find nothing to change). Reports
+throughput per stage, API calls per method and Gmail quota units spent, and
+fails if fetching spent more quota units per second than --quota allows.
+
+    python benchmarks/offline.py --messages 20000 --issuers 3 --latency-ms 20 --rate-limit 0.01
+
+Add --async to go through the asyncio transport instead of batch requests.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.auth.credentials import AnonymousCredentials
+
+import main
+from fakegoogle import FakeGoogleServer, SyntheticMailbox
+from mailmint.google.gmail import GMail
+from mailmint.google.gsheet import GSheet
+from mailmint.google.ratelimit import QUOTA_UNITS
+from mailmint.metrics import metrics
+
+
+def quota_units(calls):
+    return sum(calls[f"gmail.{method}"] * units for method, units in QUOTA_UNITS.items())
+
+
+def run(args):
+    mailbox = SyntheticMailbox(args.messages, issuers=args.issuers, mix=args.mix, noise=args.noise, seed=args.seed)
+    if args.metadata_filter:
+        for issuer in mailbox.issuers:
+            issuer["metadata_filter"] = {"snippet": ["inr", "rs."]}
+    parsers = [main.get_parser_for_issuer(dict(issuer)) for issuer in mailbox.issuers]
+    results = {"messages": args.messages, "stages": {}}
+
+    with FakeGoogleServer(mailbox, latency=args.latency_ms / 1000, rate_limit=args.rate_limit, seed=args.seed) as server:
+        gmail = GMail(credentials=AnonymousCredentials(), root_url=server.url, quota_per_second=args.quota)
+        sheets_client = GSheet(credentials=AnonymousCredentials(), root_url=server.url)
+
+        def stage(name, items, fn):
+            before = server.snapshot()
+            start = time.perf_counter()
+            value = fn()
+            elapsed = time.perf_counter() - start
+            calls = server.snapshot() - before
+            results["stages"][name] = {
+                "seconds": round(elapsed, 3),
+                "items": items(value),
+                "per_second": round(items(value) / elapsed, 1) if elapsed else None,
+                "calls": {k: v for k, v in sorted(calls.items()) if not k.startswith("bytes")},
+                "quota_units": quota_units(calls),
+                "bytes_sent": calls["bytes_sent"],
+            }
+            return value
+
+        def fetch():
+            if not args.use_async:
+                return [gmail.get_emails(issuer["email_query"], "2000/01/01", prefilter=main.metadata_prefilter(parser))
+                        for issuer, parser in zip(mailbox.issuers, parsers)]
+
+            async def fetch_all():
+                # every issuer in flight at once on one event loop
+                async with gmail.aio(concurrency=args.concurrency) as client:
+                    return await asyncio.gather(*(
+                        client.get_emails(issuer["email_query"], "2000/01/01", prefilter=main.metadata_prefilter(parser))
+                        for issuer, parser in zip(mailbox.issuers, parsers)))
+            return asyncio.run(fetch_all())
+
+        fetched = stage("fetch", lambda msgs: sum(len(m) for m in msgs), fetch)
+
+        def parse():
+            if not args.processes:
+                return [trx for parser, msgs in zip(parsers, fetched) for trx in main.extract_transactions(msgs, parser)]
+            routed = ((msg, [i]) for i, msgs in enumerate(fetched) for msg in msgs)
+            stats = [Counter() for _ in parsers]
+            return [trx for _, trx in main.parse_routed(routed, parsers, stats, pool=pool)]
+
+        main.config.update(issuers=mailbox.issuers, parse_processes=args.processes)
+        pool = main.start_parse_pool(args.processes) if args.processes else None
+        if pool:
+            # start the workers (spawn + import) before timing
+            list(pool.map(abs, range(args.processes)))
+        transactions = stage("parse", len, parse)
+        if pool:
+            pool.shutdown()
+
+        sheets = dict(main.prepare_transaction_sheets(transactions))
+        rows = sum(len(r) for r in sheets.values())
+        def write():
+            if not args.use_async:
+                return sheets_client.write_sheets("bench", sheets)
+
+            async def write_async():
+                async with sheets_client.aio() as client:
+                    await client.write_sheets("bench", sheets)
+            return asyncio.run(write_async())
+
+        for name in ("sheets", "sheets_unchanged"):
+            stage(name, lambda _: rows, write)
+
+        results["total_calls"] = dict(sorted(server.snapshot().items()))
+    results["metrics"] = metrics.report()
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="mailbox size")
+    parser.add_argument("--issuers", type=int, default=3)
+    parser.add_argument("--mix", type=float, nargs="+", help="relative share of mail per issuer")
+    parser.add_argument("--noise", type=float, default=0.2, help="fraction of issuer mail that is not a transaction")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added latency per HTTP request")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of messages.get answered with 429")
+    parser.add_argument("--quota", type=float, default=250, help="client quota units per second (Gmail's per-user limit is 250)")
+    parser.add_argument("--metadata-filter", action="store_true",
+                        help="fetch metadata first and download bodies only when the snippet has a keyword")
+    parser.add_argument("--processes", type=int, default=0, help="parse on a pool of this many worker processes")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="use the asyncio transport (mailmint.google.aio, needs httpx) instead of batch requests")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight per client with --async")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args()
+
+    # main configures INFO logging on import; keep the report readable
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'stage':<18}{'seconds':>9}{'items':>9}{'items/s':>11}{'quota':>8}{'MB':>8}  calls")
+        for name, s in results["stages"].items():
+            calls = ", ".join(f"{k}={v}" for k, v in s["calls"].items() if k != "http_requests")
+            print(f"{name:<18}{s['seconds']:>9.3f}{s['items']:>9}{s['per_second'] or 0:>11.1f}{s['quota_units']:>8}"
+                  f"{s['bytes_sent'] / 1e6:>8.2f}  {calls}")
+
+    fetch = results["stages"]["fetch"]
+    # one second of burst (the bucket's capacity) plus `quota` units per second
+    allowed = args.quota * (1 + fetch["seconds"])
+    if fetch["quota_units"] > allowed:
+        sys.exit(f"Fetching spent {fetch['quota_units']} quota units in {fetch['seconds']}s, "
+                 f"more than the {allowed:.0f} allowed at --quota {args.quota:g}")
+
+
+if __name__ == "__main__":
+    main_()
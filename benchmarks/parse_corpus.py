@@ -0,0 +1,141 @@
+"""
+Measure parser throughput and correctness on a corpus of real-looking alert emails.
+
+The corpus (default benchmarks/corpus) has one directory per issuer holding:
+- issuer.yml: the issuer's entry as in config.yml (name, patterns or parser_class, ...)
+- <name>.html: an anonymised email body, e.g. a file written by dump_email to /tmp
+- <name>.json: what parse_email_body should return for it, {} for emails that are
+  not transactions (no required keywords or no match)
+
+Each issuer's bodies are parsed repeatedly for --seconds and reported in
+messages/sec. The run fails if any output differs from its .json, or, with
+--baseline, if an issuer got more than --threshold slower than the saved
+baseline. Baselines are only comparable on the same machine.
+
+    python benchmarks/parse_corpus.py --save-baseline baseline.json
+    python benchmarks/parse_corpus.py --baseline baseline.json --threshold 0.3
+
+Add a body to the corpus by copying it into an issuer directory and running with
+--write-expected, which writes the current output for bodies without a .json.
+Review the new files before committing them.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import main
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def load_issuer(path, write_expected=False):
+    """Return (issuer config, [(name, body, expected details)]) for one corpus directory."""
+    with open(os.path.join(path, "issuer.yml"), "r") as f:
+        issuer = yaml.safe_load(f)
+    parser = main.get_parser_for_issuer(issuer)
+
+    emails = []
+    for html_path in sorted(glob.glob(os.path.join(path, "*.html"))):
+        name = os.path.splitext(os.path.basename(html_path))[0]
+        with open(html_path, "r", encoding="utf-8") as f:
+            body = f.read()
+        expected_path = os.path.join(path, name + ".json")
+        if not os.path.exists(expected_path):
+            if not write_expected:
+                sys.exit(f"{expected_path} is missing, run with --write-expected to create it")
+            with open(expected_path, "w") as f:
+                json.dump(parse(parser, name, body), f, indent=2)
+                f.write("\n")
+            print(f"wrote {expected_path}, review it")
+        with open(expected_path, "r") as f:
+            emails.append((name, body, json.load(f)))
+    return issuer, parser, emails
+
+
+def parse(parser, name, body):
+    """Parse one body the way main.parse_payload does, returning the details or {}."""
+    msg = {"id": name}
+    if not parser.has_required_keywords(body, msg):
+        return {}
+    return parser.parse_email_body(body, msg) or {}
+
+
+def measure(parser, emails, seconds):
+    """messages/sec over repeated passes of the corpus, for at least `seconds`."""
+    for name, body, _ in emails:
+        # warm up: the matcher compiles some alternations lazily on first use
+        parse(parser, name, body)
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for name, body, _ in emails:
+            parse(parser, name, body)
+        count += len(emails)
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main_():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--corpus", default=CORPUS, help="corpus directory (default benchmarks/corpus)")
+    ap.add_argument("--seconds", type=float, default=1.0, help="time spent measuring each issuer")
+    ap.add_argument("--baseline", help="JSON file of messages/sec per issuer to compare against")
+    ap.add_argument("--threshold", type=float, default=0.3,
+                    help="fail if throughput is more than this fraction below the baseline (default 0.3)")
+    ap.add_argument("--save-baseline", help="write this run's messages/sec per issuer to this JSON file")
+    ap.add_argument("--write-expected", action="store_true", help="create missing .json files from current output")
+    args = ap.parse_args()
+
+    # main configures INFO logging on import; keep the report readable
+    main.logging.getLogger().setLevel(main.logging.WARNING)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    failures = []
+    results = {}
+    print(f"{'issuer':<28}{'parser':<22}{'emails':>7}{'correct':>9}{'msg/s':>11}{'baseline':>11}{'change':>8}")
+    for path in sorted(glob.glob(os.path.join(args.corpus, "*", "issuer.yml"))):
+        issuer, parser, emails = load_issuer(os.path.dirname(path), args.write_expected)
+        name = issuer["name"]
+
+        correct = 0
+        for email_name, body, expected in emails:
+            actual = parse(parser, email_name, body)
+            if actual == expected:
+                correct += 1
+            else:
+                failures.append(f"{name}/{email_name}: expected {expected}, got {actual}")
+
+        rate = results[name] = measure(parser, emails, args.seconds) if emails else 0.0
+        before = baseline.get(name)
+        change = ""
+        if before:
+            change = f"{rate / before - 1:+.0%}"
+            if rate < before * (1 - args.threshold):
+                failures.append(f"{name}: {rate:,.0f} msg/s is more than {args.threshold:.0%} below "
+                                f"the baseline of {before:,.0f} msg/s")
+        print(f"{name:<28}{type(parser).__name__:<22}{len(emails):>7}{correct:>9}{rate:>11,.0f}"
+              f"{before or 0:>11,.0f}{change:>8}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if failures:
+        sys.exit("\n".join(["FAILED:"] + failures))
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,123 @@
+"""
+Benchmark BaseIssuerParser throughput as the number of configured patterns grows.
+
+Compares the previous approach (lowercase the body once per required keyword,
+then regex-search every pattern in turn) with the compiled PatternMatcher. Both
+sides do the keyword precheck and find the winning pattern's match; turning the
+match into a transaction is the same either way and is left out.
+
+Before timing, the matcher is checked against searching the patterns one by one
+for every pattern count from 1 up to the largest given, so the single-pattern
+path, the combined alternation and its narrowing are all covered.
+
+    python benchmarks/parse_patterns.py --messages 2000 --patterns 1 5 20 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailmint.issuers.base import BaseIssuerParser, DEFAULT_REQUIRED_KEYWORDS
+
+FILLER = "<p>Thank you for banking with us. This is a system generated alert, please do not reply.</p>"
+
+
+def make_issuer(n_patterns):
+    patterns = []
+    for i in range(n_patterns):
+        patterns.append({
+            "pattern": rf"Rs\.\s*(?P<amount>[0-9,]+\.\d{{2}}) action{i} on .*XX(?P<account>\d{{4}}) at (?P<merchant>.*?) on ",
+            "direction": -1,
+        })
+    return {"name": "Bench Bank", "patterns": patterns}
+
+
+def make_bodies(n_messages, n_patterns, seed=0):
+    rnd = random.Random(seed)
+    bodies = []
+    for _ in range(n_messages):
+        action = rnd.randrange(n_patterns)
+        alert = f"Rs. {rnd.randint(1, 99999):,}.{rnd.randint(0, 99):02d} action{action} on your account XX{rnd.randint(1000, 9999)} at SHOP {rnd.randint(1, 500)} on 01-01-25"
+        bodies.append("<html><body>" + FILLER * 30 + alert + FILLER * 30 + "</body></html>")
+    return bodies
+
+
+def make_check_bodies(n_messages, n_patterns, seed=0):
+    """make_bodies, plus bodies with several alerts (so configured order decides) and with none."""
+    rnd = random.Random(seed)
+    bodies = make_bodies(n_messages, n_patterns, seed)
+    alerts = [body[body.index("Rs. "):body.index(" on 01-01-25") + 12] for body in bodies]
+    for body in make_bodies(n_messages, n_patterns, seed + 1):
+        bodies.append(FILLER.join(rnd.sample(alerts, 3)) + body)
+    bodies.append("<html><body>" + FILLER * 60 + "</body></html>")
+    return bodies
+
+
+def match_signature(entry, data):
+    if data is None:
+        return None
+    return (entry["index"], data.group(), data.span(), data.groups(), data.groupdict(),
+            {name: data.span(name) for name in data.re.groupindex})
+
+
+def check_equivalence(max_patterns, n_messages):
+    for n in range(1, max_patterns + 1):
+        parser = BaseIssuerParser(make_issuer(n))
+        for body in make_check_bodies(n_messages, n, seed=n):
+            expected = next((match_signature(entry, data) for entry in parser.patterns
+                             for data in [entry["pattern"].search(body)] if data), None)
+            actual = match_signature(*parser.matcher.search(body))
+            if actual != expected:
+                sys.exit(f"compiled matcher disagrees with searching one by one for {n} patterns:\n"
+                         f"  expected {expected}\n  got      {actual}")
+
+
+def legacy_parse(parser, body):
+    if not any(kw.lower() in body.lower() for kw in DEFAULT_REQUIRED_KEYWORDS):
+        return None
+    for entry in parser.patterns:
+        data = entry["pattern"].search(body)
+        if data:
+            return entry["index"], data.group("merchant", "amount", "account")
+    return None
+
+
+def compiled_parse(parser, body):
+    if not parser.has_required_keywords(body):
+        return None
+    entry, data = parser.matcher.search(body)
+    return (entry["index"], data.group("merchant", "amount", "account")) if data else None
+
+
+def measure(fn, parser, bodies):
+    # warm up: the matcher compiles some alternations lazily on first use
+    for body in bodies[:200]:
+        fn(parser, body)
+    start = time.perf_counter()
+    results = [fn(parser, body) for body in bodies]
+    return len(bodies) / (time.perf_counter() - start), results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--patterns", type=int, nargs="+", default=[1, 5, 20, 50])
+    args = ap.parse_args()
+
+    check_equivalence(max(args.patterns), min(args.messages, 200))
+    print(f"{'patterns':>8} {'before msg/s':>14} {'after msg/s':>14} {'speedup':>8}")
+    for n in args.patterns:
+        parser = BaseIssuerParser(make_issuer(n))
+        bodies = make_bodies(args.messages, n)
+        before, expected = measure(legacy_parse, parser, bodies)
+        after, actual = measure(compiled_parse, parser, bodies)
+        if actual != expected:
+            sys.exit(f"compiled matcher disagrees with the legacy parser for {n} patterns")
+        print(f"{n:>8} {before:>14,.0f} {after:>14,.0f} {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Check that Gmail quota pacing never spends more than the configured rate.
+
+Several threads fetch full-size batches (AdaptiveBatchSize.maximum messages.get
+calls each) through one TokenBucket, as the threads of one mailbox do. Over the
+run they may spend at most the bucket's initial burst plus `rate` units per second.
+
+    python benchmarks/ratelimit.py --rate 250 --threads 2 --batches 3
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailmint.google.ratelimit import QUOTA_UNITS, AdaptiveBatchSize, TokenBucket
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--rate", type=float, default=250, help="quota units per second (Gmail's per-user limit is 250)")
+    ap.add_argument("--threads", type=int, default=2)
+    ap.add_argument("--batches", type=int, default=3, help="full-size batches per thread")
+    args = ap.parse_args()
+
+    bucket = TokenBucket(rate=args.rate)
+    units = AdaptiveBatchSize().maximum * QUOTA_UNITS["messages.get"]
+    spent = []  # (seconds since start, units) per batch
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def fetch():
+        for _ in range(args.batches):
+            bucket.acquire(units)
+            with lock:
+                spent.append((time.monotonic() - start, units))
+
+    threads = [threading.Thread(target=fetch) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = 0
+    for at, cost in sorted(spent):
+        total += cost
+        # every prefix of the run must stay within the burst plus the refill so far
+        allowed = bucket.capacity + at * args.rate
+        if total > allowed * 1.01:
+            sys.exit(f"Spent {total:.0f} units after {at:.2f}s, more than the {allowed:.0f} allowed at {args.rate:g}/s")
+    elapsed = max(at for at, _ in spent)
+    print(f"{total:.0f} units in {elapsed:.2f}s with batches of {units} units: "
+          f"{(total - bucket.capacity) / elapsed:.0f} units/s after the initial burst (limit {args.rate:g}/s)")
+
+
+if __name__ == "__main__":
+    main()
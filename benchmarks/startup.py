@@ -0,0 +1,75 @@
+"""
+Benchmark process start-up cost of a run that finds nothing new.
+
+Each sample runs in a fresh interpreter and measures, in process CPU time:
+importing main, building a GMail and a GSheet client from a (fake, never
+refreshed) token, and grouping synthetic transactions into month sheets.
+No network calls are made.
+
+    python benchmarks/startup.py --runs 5 --rows 5000 --budget 1.0
+"""
+import argparse
+import json
+import os
+import pickle
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = r"""
+import json, sys, time
+t0 = time.process_time()
+import main
+t1 = time.process_time()
+from mailmint.google.gmail import GMail
+from mailmint.google.gsheet import GSheet
+GMail(creds="unused.json", token=sys.argv[1])
+GSheet(creds="unused.json", token=sys.argv[1])
+t2 = time.process_time()
+rows = [{"id": str(i), "date": "2025-%02d-%02d" % (i % 12 + 1, i % 28 + 1), "amount": -1.0 * i,
+         "merchant": "SHOP %d" % (i % 97), "account": "Bank xx1234", "category": "Uncategorized"}
+        for i in range(int(sys.argv[2]))]
+t3 = time.process_time()
+sheets = dict(main.prepare_transaction_sheets(rows))
+t4 = time.process_time()
+print(json.dumps({"import": t1 - t0, "clients": t2 - t1, "grouping": t4 - t3, "total": time.process_time()}))
+"""
+
+
+def make_token(path):
+    from google.oauth2.credentials import Credentials
+    creds = Credentials(token="offline", expiry=datetime.utcnow() + timedelta(days=365))
+    with open(path, "wb") as f:
+        pickle.dump(creds, f)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--budget", type=float, default=1.0, help="fail if median total process time exceeds this (seconds)")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        token = os.path.join(tmp, "token.pickle")
+        make_token(token)
+        samples = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, "-c", CHILD, token, str(args.rows)],
+                                 cwd=ROOT, check=True, capture_output=True, text=True)
+            samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    for stage in ("import", "clients", "grouping", "total"):
+        print(f"{stage:>9}: {statistics.median(s[stage] for s in samples) * 1000:8.1f} ms")
+
+    total = statistics.median(s["total"] for s in samples)
+    if total > args.budget:
+        sys.exit(f"median process time {total:.3f}s exceeds budget of {args.budget:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
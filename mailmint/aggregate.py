@@ -0,0 +1,45 @@
+from collections import defaultdict
+
+from mailmint.dedup import transaction_key
+
+# column order of the month sheets
+SHEET_COLUMNS = ("date", "amount", "merchant", "account", "category")
+
+
+class MonthAggregator:
+    """
+    Collects sheet rows per calendar month as transactions are parsed.
+
+    Only the small row lists (and the transaction_key of each row) are kept, so the
+    messages they came from can be dropped as soon as they have been parsed. If
+    given, `categorize(merchant)` (e.g. a mailmint.categories.Categorizer) sets
+    each row's category.
+    """
+
+    def __init__(self, transactions=(), categorize=None):
+        self.months = defaultdict(list)
+        self.categorize = categorize
+        self.extend(transactions)
+
+    def add(self, transaction):
+        row = [transaction[c] for c in SHEET_COLUMNS]
+        if self.categorize:
+            row[SHEET_COLUMNS.index("category")] = self.categorize(transaction["merchant"])
+        self.months[transaction["date"][:7]].append((transaction_key(transaction), row))
+
+    def extend(self, transactions):
+        for trx in transactions:
+            self.add(trx)
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.months.values())
+
+    def records(self):
+        """Yield (month, [(transaction key, row)]) in month order, rows sorted by date (stable for same-day rows)."""
+        for month in sorted(self.months):
+            yield month, sorted(self.months[month], key=lambda record: record[1][0])
+
+    def sheets(self):
+        """Yield (month, rows) like records(), without the keys."""
+        for month, records in self.records():
+            yield month, [row for _, row in records]
@@ -0,0 +1,85 @@
+import json
+import os
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def parse_month(value):
+    """'2024-03' -> datetime(2024, 3, 1)"""
+    return datetime.strptime(value, "%Y-%m")
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def month_windows(first_month, last_month, months_per_window=1):
+    """
+    Split the months first_month..last_month (inclusive, as returned by
+    parse_month) into [(start, end)] windows of whole months, end exclusive.
+    Boundaries are local midnights, so windows line up with the month sheets.
+    """
+    if months_per_window < 1:
+        raise ValueError(f"months_per_window must be at least 1, got {months_per_window}")
+    if last_month < first_month:
+        raise ValueError(f"last month {last_month:%Y-%m} is before first month {first_month:%Y-%m}")
+    windows = []
+    start = first_month
+    end_of_range = add_months(last_month, 1)
+    while start < end_of_range:
+        end = min(add_months(start, months_per_window), end_of_range)
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def window_key(account, issuer, start, end):
+    return f"{account}\t{issuer}\t{start:%Y-%m-%d}\t{end:%Y-%m-%d}"
+
+
+class BackfillCheckpoint:
+    """
+    Append-only record of finished backfill windows, one JSON object per line:
+
+      {"key": "<account>\\t<issuer>\\t<window start>\\t<window end>", "transactions": [...]}
+
+    Each window is appended and flushed to disk as soon as it finishes, so an
+    interrupted backfill resumes with the windows it has not finished yet. A line
+    torn by a crash is dropped on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.windows = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            logger.warning("Dropping an incomplete record at the end of %s", self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(len(complete))
+        for line in complete.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                self.windows[record["key"]] = record["transactions"]
+        logger.info("Loaded %d finished backfill window(s) from %s", len(self.windows), self.path)
+
+    def done(self, key):
+        return key in self.windows
+
+    def get(self, key):
+        return self.windows.get(key, [])
+
+    def add(self, key, transactions):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": key, "transactions": transactions}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.windows[key] = transactions
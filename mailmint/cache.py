@@ -0,0 +1,116 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class MessageCache:
+    """
+    On-disk SQLite cache shared by all accounts:
+    - messages: fetched Gmail payloads keyed by (message id, variant), where the
+      variant identifies the requested format/fields so differently shaped
+      responses never mix.
+    - parses: parse results keyed by (message id, parser config hash). A stored
+      NULL result means the message was seen and is not a transaction.
+
+    Entries older than `max_age_days` are evicted, then the oldest payloads are
+    dropped until the stored payloads fit in `max_size_mb`.
+    """
+
+    def __init__(self, path="cache.sqlite", max_age_days=90, max_size_mb=512):
+        self.path = path
+        self.max_age = max_age_days * 86400
+        self.max_bytes = max_size_mb * 1024 * 1024
+        # connection is shared between threads, all access goes through the lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id TEXT NOT NULL,
+                    variant TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (id, variant)
+                );
+                CREATE INDEX IF NOT EXISTS messages_fetched_at ON messages (fetched_at);
+                CREATE TABLE IF NOT EXISTS parses (
+                    id TEXT NOT NULL,
+                    config_hash TEXT NOT NULL,
+                    result TEXT,
+                    parsed_at REAL NOT NULL,
+                    PRIMARY KEY (id, config_hash)
+                );
+            """)
+
+    def get_messages(self, message_ids, variant):
+        """Return a dict id -> message for the ids present in the cache."""
+        found = {}
+        with self.lock:
+            # stay well below SQLite's bound parameter limit
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT id, payload FROM messages WHERE variant = ? AND id IN ({','.join('?' * len(chunk))})",
+                    [variant, *chunk],
+                )
+                for mid, payload in rows:
+                    found[mid] = json.loads(zlib.decompress(payload))
+        return found
+
+    def put_messages(self, messages, variant):
+        now = time.time()
+        rows = []
+        for msg in messages:
+            payload = zlib.compress(json.dumps(msg).encode("utf-8"))
+            rows.append((msg["id"], variant, payload, len(payload), now))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_parse(self, message_id, config_hash):
+        """Return (found, result) for a message parsed with the given parser config."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM parses WHERE id = ? AND config_hash = ?", (message_id, config_hash)
+            ).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def put_parse(self, message_id, config_hash, result):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO parses VALUES (?, ?, ?, ?)",
+                (message_id, config_hash, json.dumps(result) if result is not None else None, time.time()),
+            )
+
+    def evict(self):
+        cutoff = time.time() - self.max_age
+        with self.lock, self.conn:
+            aged = self.conn.execute("DELETE FROM messages WHERE fetched_at < ?", (cutoff,)).rowcount
+            aged += self.conn.execute("DELETE FROM parses WHERE parsed_at < ?", (cutoff,)).rowcount
+
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+            oversize = 0
+            if total > self.max_bytes:
+                # walk from the oldest payload until enough bytes have been freed
+                excess = total - self.max_bytes
+                rows = self.conn.execute("SELECT rowid, size FROM messages ORDER BY fetched_at")
+                doomed = []
+                for rowid, size in rows:
+                    if excess <= 0:
+                        break
+                    doomed.append((rowid,))
+                    excess -= size
+                self.conn.executemany("DELETE FROM messages WHERE rowid = ?", doomed)
+                oversize = len(doomed)
+        logger.info("Cache eviction: %d aged out, %d dropped for size.", aged, oversize)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,188 @@
+import functools
+import re
+from collections import deque
+
+import yaml
+
+from mailmint.issuers.matcher import literal_anchor
+
+DEFAULT_CATEGORY = "Uncategorized"
+
+# rule keys, each taking a list of strings
+RULE_KINDS = ("contains", "prefix", "regex")
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalise_merchant(merchant):
+    """Lowercase, single-spaced, stripped form of a merchant that rules are matched against."""
+    return _SPACES_RE.sub(" ", merchant or "").strip().lower()
+
+
+class _Automaton:
+    """
+    Aho-Corasick automaton over literal substrings, each tagged with the index of
+    its rule. A text is scanned once however many literals there are: best(text)
+    returns the lowest rule index of any literal it contains, found(text) all of them.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.rules = [()]  # rule indices of the literals ending at each state, following fail links
+        self.rule = []  # lowest of those per state, set by build()
+
+    def add(self, literal, rule):
+        state = 0
+        for char in literal:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.rules.append(())
+                self.goto[state][char] = nxt
+            state = nxt
+        self.rules[state] += (rule,)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(char, 0)
+                self.rules[nxt] += self.rules[self.fail[nxt]]
+        self.rule = [min(rules) if rules else None for rules in self.rules]
+
+    def _states(self, text):
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            yield state
+
+    def best(self, text):
+        best = None
+        for state in self._states(text):
+            rule = self.rule[state]
+            if rule is not None and (best is None or rule < best):
+                best = rule
+        return best
+
+    def found(self, text):
+        return {rule for state in self._states(text) for rule in self.rules[state]}
+
+
+class _PrefixTrie:
+    """Trie over literal prefixes; best(text) is the lowest rule index of any prefix of the text."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, literal, rule):
+        node = self.root
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[None] = min(rule, node.get(None, rule))
+
+    def best(self, text):
+        best = None
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            rule = node.get(None)
+            if rule is not None and (best is None or rule < best):
+                best = rule
+        return best
+
+
+class Categorizer:
+    """
+    Maps merchants to categories using the `categories` rules from config.yml.
+
+    Each rule names a `category` and lists any of `contains` (substrings),
+    `prefix` and `regex` (case-insensitive, searched) patterns, all matched
+    against the normalised merchant. The first rule in config order with a
+    matching pattern wins; merchants no rule matches get `default`.
+
+    Literal patterns are compiled into one Aho-Corasick automaton and one prefix
+    trie, so a merchant is scanned once however many literal rules there are.
+    Regex rules are only tried if they come before the best literal match and
+    the merchant contains the literal text every match of the regex needs.
+    Results are memoised per normalised merchant in an LRU cache of `cache_size`.
+    """
+
+    def __init__(self, rules, default=DEFAULT_CATEGORY, cache_size=10000):
+        self.default = default
+        self.categories = []
+        self.contains = _Automaton()
+        self.prefixes = _PrefixTrie()
+        # regexes are only run if their literal anchor (see literal_anchor) is in the merchant
+        self.regexes = {}  # position -> (rule index, compiled regex)
+        self.anchors = _Automaton()
+        self.unanchored = []  # positions of regexes without an anchor
+
+        for index, rule in enumerate(rules):
+            if not rule.get("category"):
+                raise ValueError(f"Category rule #{index + 1} has no 'category'")
+            unknown = set(rule) - set(RULE_KINDS) - {"category"}
+            if unknown:
+                raise ValueError(f"Unknown key(s) {', '.join(sorted(unknown))} in category rule '{rule['category']}'")
+            self.categories.append(rule["category"])
+            for literal in rule.get("contains", []):
+                self.contains.add(normalise_merchant(literal), index)
+            for literal in rule.get("prefix", []):
+                self.prefixes.add(normalise_merchant(literal), index)
+            for pattern in rule.get("regex", []):
+                regex = re.compile(pattern, re.IGNORECASE)
+                position = len(self.regexes)
+                self.regexes[position] = (index, regex)
+                anchor = literal_anchor(regex)
+                if anchor:
+                    self.anchors.add(anchor, position)
+                else:
+                    self.unanchored.append(position)
+        self.contains.build()
+        self.anchors.build()
+
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._categorize)
+
+    def __call__(self, merchant):
+        """Category of `merchant`."""
+        return self._lookup(normalise_merchant(merchant))
+
+    def _categorize(self, merchant):
+        candidates = [rule for rule in (self.contains.best(merchant), self.prefixes.best(merchant)) if rule is not None]
+        best = min(candidates) if candidates else len(self.categories)
+        for position in sorted(self.anchors.found(merchant).union(self.unanchored)):
+            index, regex = self.regexes[position]
+            if index >= best:
+                break
+            if regex.search(merchant):
+                best = index
+                break
+        return self.categories[best] if best < len(self.categories) else self.default
+
+
+def build_categorizer(categories_config):
+    """
+    Return a Categorizer for the `categories` config section, or None if it is empty.
+
+    Rules are taken from `rules` and/or from a YAML list of rules in `file`, the
+    inline ones first.
+    """
+    if not categories_config:
+        return None
+    rules = list(categories_config.get("rules", []))
+    if categories_config.get("file"):
+        with open(categories_config["file"], "r") as f:
+            rules.extend(yaml.safe_load(f) or [])
+    return Categorizer(rules, default=categories_config.get("default", DEFAULT_CATEGORY),
+                       cache_size=categories_config.get("cache_size", 10000))
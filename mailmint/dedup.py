@@ -0,0 +1,74 @@
+import hashlib
+import threading
+
+from mailmint.helpers import get_headers
+from mailmint.metrics import metrics
+
+
+def message_fingerprint(metadata):
+    """
+    Key identifying the same email across mailboxes: its RFC822 Message-ID, or
+    for messages without one a hash of From, Subject, Date and the snippet.
+    `metadata` is a message fetched in metadata (or full) format.
+    """
+    headers = get_headers(metadata)
+    message_id = headers.get("message-id", "").strip().lower()
+    if message_id:
+        return "id:" + message_id
+    content = "\0".join([headers.get("from", ""), headers.get("subject", ""), headers.get("date", ""),
+                         metadata.get("snippet", "")])
+    return "sha1:" + hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def transaction_key(transaction):
+    """Key of a transaction across mailboxes: the fingerprint of its email, or its message id if it has none."""
+    return transaction.get("fingerprint") or transaction.get("id")
+
+
+def unique_transactions(transactions):
+    """Drop transactions from an email already seen earlier in `transactions`, e.g. a copy kept by another account."""
+    seen = set()
+    unique = []
+    for trx in transactions:
+        key = transaction_key(trx)
+        if key not in seen:
+            seen.add(key)
+            unique.append(trx)
+    if len(unique) < len(transactions):
+        metrics.inc("duplicates_skipped_total", len(transactions) - len(unique))
+    return unique
+
+
+class MessageIndex:
+    """
+    Thread-safe index of claimed emails, shared by the GMail clients of every account.
+
+    A message is claimed per `scope` (the Gmail query it was listed for, without
+    its date bounds) by the first account (see GMail.account) that lists it.
+    Other accounts listing the same email for the same query are refused, so a
+    CC'd or copied alert is fetched and parsed only once. The claiming account
+    itself can claim it again, e.g. when another fetch unit lists it with
+    another query.
+
+    Emails kept from earlier runs are seeded before fetching starts, so they stay
+    with the account that already holds them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = {}  # (scope, fingerprint) -> owner
+
+    def seed(self, scope, fingerprint, owner):
+        """Record that `owner` already holds the email with `fingerprint` for `scope`."""
+        with self.lock:
+            self.owners.setdefault((scope, fingerprint), owner)
+
+    def claim(self, scope, metadata, owner):
+        """Return True if `owner` may fetch this message for `scope`, False if another owner already has."""
+        key = (scope, message_fingerprint(metadata))
+        with self.lock:
+            claimed_by = self.owners.setdefault(key, owner)
+        if claimed_by != owner:
+            metrics.inc("duplicates_skipped_total")
+            return False
+        return True
@@ -0,0 +1,353 @@
+"""
+Optional asyncio transport for the Gmail and Sheets calls mailmint makes.
+
+Requests go over one pooled keep-alive httpx.AsyncClient per client, using
+HTTP/2 when the `h2` package is installed, so many list and get calls can be in
+flight on one event loop without a thread each. Get the async counterpart of a
+client with GMail.aio() or GSheet.aio(); it shares the client's credentials,
+root_url, quota bucket and message cache.
+
+Needs `httpx` (and optionally `h2`), which are not part of requirements.txt:
+
+    pip install httpx h2
+"""
+import asyncio
+import logging
+import random
+
+from mailmint.google.gmail import METADATA_FIELDS, METADATA_HEADERS, FULL_FIELDS, cache_variant
+from mailmint.google.gsheet import changed_blocks, column_letter, sheet_range
+from mailmint.google.ratelimit import QUOTA_UNITS
+from mailmint.metrics import metrics
+
+GMAIL_ROOT_URL = "https://gmail.googleapis.com/"
+SHEETS_ROOT_URL = "https://sheets.googleapis.com/"
+
+
+class AsyncHttpError(Exception):
+    """Non-2xx response to an async request."""
+
+    def __init__(self, status, content):
+        super().__init__(f"HTTP {status}: {content[:200]}")
+        self.status = status
+        self.content = content
+
+    @property
+    def rate_limited(self):
+        return self.status in (429, 403) and ("rateLimitExceeded" in self.content
+                                              or "userRateLimitExceeded" in self.content)
+
+
+class AsyncTransport:
+    """
+    Authorized, pooled HTTP client for one account and API root.
+
+    Expired credentials are refreshed on a worker thread (google-auth only refreshes
+    synchronously), once however many requests are waiting for it.
+    """
+
+    def __init__(self, credentials, root_url, max_connections=20, http2=True):
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("The async transport needs httpx: pip install httpx h2") from e
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                http2 = False
+
+        self.credentials = credentials
+        self.root_url = root_url
+        self.refresh_lock = asyncio.Lock()
+        self.client = httpx.AsyncClient(
+            base_url=root_url, http2=http2, timeout=60,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def _authorize(self, headers):
+        if not self.credentials.valid:
+            async with self.refresh_lock:
+                if not self.credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        self.credentials.apply(headers)
+
+    async def request(self, method, path, params=None, body=None):
+        """Send one request and return the decoded JSON response, raising AsyncHttpError on failure."""
+        headers = {}
+        await self._authorize(headers)
+        response = await self.client.request(method, path, params=params, json=body, headers=headers)
+        metrics.inc("bytes_downloaded_total", len(response.content))
+        if response.status_code >= 400:
+            raise AsyncHttpError(response.status_code, response.text)
+        return response.json() if response.content else {}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class AsyncGMail:
+    """
+    Async counterpart of GMail: list, get and iter_emails/get_emails for one mailbox.
+
+    Messages are fetched with concurrent messages.get calls (multiplexed on one
+    connection with HTTP/2) instead of batch requests, paced by the GMail client's
+    quota bucket. At most `concurrency` requests are in flight, and only those
+    wait on the quota bucket. Rate-limited calls back off and retry like
+    iter_fetch_messages. The GMail client's dedup index, if any, is honoured.
+    """
+
+    def __init__(self, gmail, concurrency=20, http2=True):
+        self.gmail = gmail
+        self.logger = logging.getLogger(__name__)
+        self.concurrency = concurrency
+        self.transport = AsyncTransport(gmail.credentials, gmail.root_url or GMAIL_ROOT_URL,
+                                        max_connections=concurrency, http2=http2)
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def _spend(self, method, count=1):
+        """Async GMail._spend: wait for quota without blocking the event loop."""
+        bucket = self.gmail.rate_limiter
+        units = QUOTA_UNITS[method] * count
+        while units > 0:
+            part = min(units, bucket.capacity)
+            while True:
+                wait = bucket.take(part)
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            units -= part
+        metrics.api_call(method, count)
+
+    async def _request(self, method, path, params):
+        """One quota-paced API call, holding one of the `concurrency` slots."""
+        async with self.semaphore:
+            await self._spend(method)
+            return await self.transport.request("GET", path, params)
+
+    async def list_message_ids(self, query, after, before=None):
+        """Ids of all messages matching `query` in the window, see GMail.get_emails."""
+        params = {"q": f'{query} after:{after}' + (f' before:{before}' if before else '') + ' in:anywhere',
+                  "maxResults": 500}
+        message_ids = []
+        with metrics.timer("list"):
+            while True:
+                res = await self._request("messages.list", "gmail/v1/users/me/messages", params)
+                message_ids.extend(m["id"] for m in res.get("messages", []))
+                if not res.get("nextPageToken"):
+                    return message_ids
+                params["pageToken"] = res["nextPageToken"]
+
+    async def get_message(self, message_id, fmt="full", fields=None, metadata_headers=None,
+                          max_retries=5, initial_delay=1.0):
+        """Fetch one message, or None if it failed (logged, like iter_fetch_messages)."""
+        params = {"format": fmt}
+        if fields:
+            params["fields"] = fields
+        if metadata_headers:
+            params["metadataHeaders"] = metadata_headers
+        for attempt in range(max_retries + 1):
+            try:
+                return await self._request("messages.get", f"gmail/v1/users/me/messages/{message_id}", params)
+            except AsyncHttpError as e:
+                if not e.rate_limited:
+                    self.logger.warning("Error fetching message %s: %s", message_id, e)
+                    break
+                metrics.inc("rate_limited_total")
+                if attempt == max_retries:
+                    self.logger.error("Failed to fetch message %s after %d retries (rate limited)",
+                                      message_id, max_retries)
+                    break
+                metrics.inc("fetch_retries_total")
+                # one of up to `concurrency` requests in flight was refused, see GMail.iter_fetch_messages
+                self.gmail.rate_limiter.backoff(initial_delay / self.concurrency)
+                # back off without holding a slot
+                await asyncio.sleep(initial_delay * (2 ** attempt) + random.uniform(0, 1))
+        metrics.inc("fetch_failures_total")
+        return None
+
+    async def iter_messages(self, message_ids, fmt="full", fields=None, metadata_headers=None, batch_size=100):
+        """
+        Async iter_fetch_messages: yield lists of up to `batch_size` fetched messages
+        as they arrive, skipping failures.
+
+        `concurrency` worker tasks pull ids from a queue, so only that many
+        requests (and at most one batch of results) are pending at a time, however
+        many ids there are. Uses and fills the GMail client's message cache.
+        """
+        cache = self.gmail.cache
+        if cache:
+            variant = cache_variant(fmt, fields, metadata_headers)
+            missing = []
+            hits = 0
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                cached = cache.get_messages(chunk, variant)
+                missing.extend(mid for mid in chunk if mid not in cached)
+                if cached:
+                    hits += len(cached)
+                    yield list(cached.values())
+            metrics.inc("cache_hits_total", hits)
+            metrics.inc("cache_misses_total", len(missing))
+            message_ids = missing
+        if not message_ids:
+            return
+
+        ids = asyncio.Queue()
+        for mid in message_ids:
+            ids.put_nowait(mid)
+        results = asyncio.Queue(maxsize=batch_size)
+
+        async def worker():
+            while not ids.empty():
+                mid = ids.get_nowait()
+                try:
+                    await results.put(await self.get_message(mid, fmt, fields, metadata_headers))
+                except Exception as e:
+                    await results.put(e)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(message_ids)))]
+        try:
+            fetched = []
+            for remaining in range(len(message_ids), 0, -1):
+                with metrics.timer("fetch"):
+                    msg = await results.get()
+                if isinstance(msg, Exception):
+                    raise msg
+                if msg:
+                    fetched.append(msg)
+                if fetched and (len(fetched) >= batch_size or remaining == 1):
+                    metrics.inc("messages_fetched_total", len(fetched))
+                    if cache:
+                        cache.put_messages(fetched, variant)
+                    yield fetched
+                    fetched = []
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def get_messages(self, message_ids, fmt="full", fields=None, metadata_headers=None):
+        """Fetch many messages, in the order of `message_ids`, skipping failures. See iter_messages."""
+        by_id = {}
+        async for batch in self.iter_messages(message_ids, fmt, fields, metadata_headers):
+            by_id.update((msg["id"], msg) for msg in batch)
+        return [by_id[mid] for mid in message_ids if mid in by_id]
+
+    async def filter_by_metadata(self, message_ids, accept):
+        """Async GMail.filter_by_metadata."""
+        kept = set()
+        with metrics.timer("metadata_filter"):
+            async for batch in self.iter_messages(message_ids, "metadata", METADATA_FIELDS, METADATA_HEADERS):
+                kept.update(msg["id"] for msg in batch if accept(msg))
+        metrics.inc("metadata_rejected_total", len(message_ids) - len(kept))
+        return [mid for mid in message_ids if mid in kept]
+
+    async def iter_emails(self, query, after, only_ids=None, prefilter=None, before=None):
+        """Async GMail.iter_emails: yield messages as their batch arrives."""
+        if only_ids is not None and not only_ids:
+            return
+        message_ids = await self.list_message_ids(query, after, before)
+        if only_ids is not None:
+            message_ids = [mid for mid in message_ids if mid in only_ids]
+        if self.gmail.dedup:
+            prefilter = self.gmail._claiming(prefilter, query)
+        if prefilter and message_ids:
+            message_ids = await self.filter_by_metadata(message_ids, prefilter)
+
+        async for batch in self.iter_messages(message_ids, "full", FULL_FIELDS):
+            for msg in batch:
+                try:
+                    msg["message_link"] = self.gmail.message_link_from_msg(msg)
+                except Exception:
+                    msg["message_link"] = None
+                yield msg
+
+    async def get_emails(self, query, after, only_ids=None, prefilter=None, before=None):
+        """Async GMail.get_emails."""
+        return [msg async for msg in self.iter_emails(query, after, only_ids, prefilter, before)]
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class AsyncGSheet:
+    """Async counterpart of GSheet.write_sheets, in the same four round trips."""
+
+    def __init__(self, gsheet, http2=True):
+        self.gsheet = gsheet
+        self.logger = logging.getLogger(__name__)
+        self.transport = AsyncTransport(gsheet.credentials, gsheet.root_url or SHEETS_ROOT_URL, max_connections=4,
+                                        http2=http2)
+
+    async def _call(self, method, api_method, path, params=None, body=None):
+        metrics.api_call(api_method)
+        return await self.transport.request(method, f"v4/spreadsheets/{path}", params, body)
+
+    async def ensure_sheets(self, spreadsheet_id, sheet_names, template_sheet="Template"):
+        """Create every missing sheet as a copy of `template_sheet`, see GSheet.ensure_sheets."""
+        res = await self._call("GET", "spreadsheets.get", spreadsheet_id,
+                               {"fields": "sheets.properties(sheetId,title)"})
+        titles = {s["properties"]["title"]: s["properties"] for s in res.get("sheets", [])}
+        missing = [name for name in sheet_names if name not in titles]
+        if not missing:
+            return
+        template = titles.get(template_sheet)
+        if not template:
+            raise ValueError(f"Template sheet '{template_sheet}' not found")
+        await self._call("POST", "spreadsheets.batchUpdate", f"{spreadsheet_id}:batchUpdate", body={
+            "requests": [{"duplicateSheet": {"sourceSheetId": template["sheetId"], "newSheetName": name}}
+                         for name in missing]
+        })
+        self.logger.info("Created sheets: %s", ", ".join(missing))
+
+    async def write_sheets(self, spreadsheet_id, sheets, template_sheet="Template"):
+        """Write only the rows that changed, see GSheet.write_sheets."""
+        sheets = {name: rows for name, rows in dict(sheets).items() if rows}
+        if not sheets:
+            return
+
+        await self.ensure_sheets(spreadsheet_id, list(sheets), template_sheet)
+
+        widths = {name: max(len(row) for row in rows) for name, rows in sheets.items()}
+        res = await self._call("GET", "values.batchGet", f"{spreadsheet_id}/values:batchGet", {
+            "ranges": [sheet_range(name, "A2", column_letter(widths[name])) for name in sheets],
+            "valueRenderOption": "UNFORMATTED_VALUE",
+        })
+
+        data = []
+        for (name, rows), value_range in zip(sheets.items(), res.get("valueRanges", [])):
+            blocks = changed_blocks(value_range.get("values", []), rows, widths[name])
+            for start, block in blocks:
+                data.append({"range": sheet_range(name, f"A{start + 2}"), "values": block})
+            self.logger.info("Sheet %s: %d rows, %d changed.", name, len(rows), sum(len(b) for _, b in blocks))
+
+        if not data:
+            self.logger.info("All %d sheet(s) already up to date.", len(sheets))
+            return
+
+        await self._call("POST", "values.batchUpdate", f"{spreadsheet_id}/values:batchUpdate",
+                         body={"valueInputOption": "RAW", "data": data})
+        self.logger.info("Written %d changed range(s) across %d sheet(s).", len(data), len(sheets))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
@@ -3,126 +3,385 @@ from urllib.parse import quote
 import logging
 import time
 import random
+import heapq
+from collections import defaultdict, deque
 
 from mailmint.google.base import BaseGoogle, register_scope
+from mailmint.google.ratelimit import TokenBucket, AdaptiveBatchSize, QUOTA_UNITS, GMAIL_USER_QUOTA_PER_SECOND
+from mailmint.google.query import GmailQueryMatcher, combine_queries
+from mailmint.helpers import get_headers
+from mailmint.metrics import metrics
 
 register_scope("https://www.googleapis.com/auth/gmail.readonly")
 
+# headers requested by the metadata pass, enough to route and filter a message
+METADATA_HEADERS = ["From", "To", "Cc", "Subject", "Date", "Message-ID"]
+
+# response fields of the full and metadata fetches (payload headers, parts, internalDate and
+# the snippet, which mailmint.dedup.message_fingerprint needs for messages without a Message-ID);
+# the whole payload is requested, since a fields mask can only name a fixed depth of nested parts
+# and a body deeper than that (e.g. a forwarded message) would never arrive
+FULL_FIELDS = "id,threadId,internalDate,snippet,payload"
+METADATA_FIELDS = "id,internalDate,snippet,payload/headers"
+
+
+def cache_variant(fmt, fields, metadata_headers=None):
+    """Key of a response shape in the message cache: the same message fetched differently is cached apart."""
+    variant = f"{fmt}:{fields}"
+    if metadata_headers:
+        variant += ":" + ",".join(metadata_headers)
+    return variant
+
 
 class GMail(BaseGoogle):
-    def __init__(self, creds="credentials.json", token="token_gmail.pickle"):
-        super().__init__("gmail", "v1", creds, token)
+    def __init__(self, creds="credentials.json", token="token_gmail.pickle", cache=None,
+                 quota_per_second=GMAIL_USER_QUOTA_PER_SECOND, credentials=None, root_url=None, dedup=None):
+        super().__init__("gmail", "v1", creds, token, credentials, root_url)
         # instance logger
         self.logger = logging.getLogger(__name__)
+        # optional mailmint.cache.MessageCache to skip re-fetching known messages
+        self.cache = cache
+        # optional mailmint.dedup.MessageIndex shared with other accounts' clients
+        self.dedup = dedup
+        # stable name of this mailbox in the dedup index, e.g. its email address
+        self.account = None
+        # shared by all threads using this mailbox, which is what Gmail's per-user quota counts
+        self.rate_limiter = TokenBucket(rate=quota_per_second)
+        self.batch_size = AdaptiveBatchSize()
 
-    def get_emails(self, query, after):
-        full_query = f'{query} after:{after} in:anywhere'
+    def aio(self, concurrency=20, http2=True):
+        """Async client for this mailbox (mailmint.google.aio.AsyncGMail), needs httpx."""
+        from mailmint.google.aio import AsyncGMail
+        return AsyncGMail(self, concurrency=concurrency, http2=http2)
 
-        # first, list message ids (handle pagination)
-        message_ids = []
-        req = self.client.users().messages().list(userId="me", q=full_query, maxResults=500)
+    def get_history_id(self):
+        """Return the mailbox's current historyId, i.e. the checkpoint for the next incremental run."""
+        self._spend("getProfile")
+        return self.client.users().getProfile(userId="me").execute(http=self.http).get("historyId")
+
+    def watch(self, topic, label_ids=None):
+        """
+        Start or renew push notifications of mailbox changes to the Pub/Sub `topic`
+        (projects/<project>/topics/<name>), optionally only for `label_ids`.
+        A watch expires after 7 days unless renewed. Returns the expiration as a
+        Unix timestamp in milliseconds.
+        """
+        body = {"topicName": topic}
+        if label_ids:
+            body.update(labelIds=label_ids, labelFilterBehavior="include")
+        self._spend("watch")
+        return int(self.client.users().watch(userId="me", body=body).execute(http=self.http).get("expiration", 0))
+
+    def get_added_message_ids(self, start_history_id):
+        """
+        Return the set of message ids added to the mailbox since `start_history_id`
+        using users.history.list.
+
+        Returns (ids, history id to use as the next checkpoint). ids is None when
+        the checkpoint has expired (Gmail answers 404 for history ids older than
+        about a week), in which case the caller must fall back to a full scan.
+        """
+        added = set()
+        latest = None
+        kwargs = dict(userId="me", startHistoryId=start_history_id, historyTypes="messageAdded", maxResults=500)
+        req = self.client.users().history().list(**kwargs)
         while req:
-            res = req.execute()
-            message_ids.extend(m["id"] for m in res.get("messages", []))
+            self._spend("history.list")
+            try:
+                res = req.execute(http=self.http)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    self.logger.info("History id %s has expired, full scan required.", start_history_id)
+                    return None, None
+                raise
+            latest = res.get("historyId", latest)
+            for record in res.get("history", []):
+                for added_msg in record.get("messagesAdded", []):
+                    added.add(added_msg["message"]["id"])
             token = res.get("nextPageToken")
-            req = self.client.users().messages().list(userId="me", q=full_query, pageToken=token, maxResults=500) if token else None
+            req = self.client.users().history().list(pageToken=token, **kwargs) if token else None
+
+        return added, latest
+
+    def get_emails(self, query, after, only_ids=None, prefilter=None, before=None):
+        """
+        Fetch all messages matching `query` received after `after` and, if given,
+        before `before`. Both are YYYY/MM/DD dates or Unix timestamps in seconds.
+
+        If `only_ids` is given (e.g. from get_added_message_ids), only listed messages
+        whose id is in that set are fetched; an empty set short-circuits without any
+        API call.
+
+        If `prefilter` is given, messages are first fetched in metadata format (see
+        filter_by_metadata) and only those for which prefilter(metadata) is true are
+        then fetched in full.
+
+        If the client has a `dedup` index, listed messages are likewise checked by
+        their metadata first, and those already claimed by another account's client
+        for the same query (in this run or, if seeded, an earlier one) are not
+        fetched (see mailmint.dedup.MessageIndex).
+        """
+        return list(self.iter_emails(query, after, only_ids=only_ids, prefilter=prefilter, before=before))
+
+    def iter_emails(self, query, after, only_ids=None, prefilter=None, before=None):
+        """Generator version of get_emails, yielding messages as their batch arrives."""
+        if only_ids is not None and not only_ids:
+            return
+
+        full_query = f'{query} after:{after}' + (f' before:{before}' if before else '') + ' in:anywhere'
+
+        # first, list message ids (handle pagination)
+        message_ids = []
+        with metrics.timer("list"):
+            req = self.client.users().messages().list(userId="me", q=full_query, maxResults=500)
+            while req:
+                self._spend("messages.list")
+                res = req.execute(http=self.http)
+                message_ids.extend(m["id"] for m in res.get("messages", []))
+                token = res.get("nextPageToken")
+                req = self.client.users().messages().list(userId="me", q=full_query, pageToken=token, maxResults=500) if token else None
+
+        if only_ids is not None:
+            message_ids = [mid for mid in message_ids if mid in only_ids]
+
+        if self.dedup:
+            prefilter = self._claiming(prefilter, query)
+        if prefilter and message_ids:
+            message_ids = self.filter_by_metadata(message_ids, prefilter)
 
         if not message_ids:
-            return {}
+            return
 
         # fetch messages in bulk (request payload headers, parts and internalDate)
-        fields = "id,threadId,internalDate,payload(headers(name,value),parts(mimeType,body/data),body/data)"
-        fetched = self.bulk_fetch_messages(message_ids, batch_size=80, fmt="full", fields=fields)
+        for batch in self.iter_fetch_messages(message_ids, fmt="full", fields=FULL_FIELDS):
+            # add `message_link` for each without extra API calls
+            for msg in batch:
+                try:
+                    msg["message_link"] = self.message_link_from_msg(msg)
+                except Exception:
+                    msg["message_link"] = None
+                yield msg
 
-        # fetched is a mapping id -> message dict; add `message_link` for each without extra API calls
-        for msg in fetched:
-            try:
-                msg["message_link"] = self.message_link_from_msg(msg)
-            except Exception:
-                msg["message_link"] = None
+    def filter_by_metadata(self, message_ids, accept):
+        """
+        Fetch only the metadata of `message_ids` (internalDate, snippet and
+        METADATA_HEADERS, no body) and return the ids for which accept(metadata)
+        is true, in their original order.
 
-        return fetched
+        Metadata costs the same quota as a full fetch but a fraction of the bytes,
+        so this pays off when many listed messages would be discarded anyway.
+        """
+        kept = set()
+        with metrics.timer("metadata_filter"):
+            for batch in self.iter_fetch_messages(message_ids, fmt="metadata", fields=METADATA_FIELDS,
+                                                  metadata_headers=METADATA_HEADERS):
+                kept.update(msg["id"] for msg in batch if accept(msg))
+
+        metrics.inc("metadata_rejected_total", len(message_ids) - len(kept))
+        self.logger.info("Metadata filter kept %d of %d message(s).", len(kept), len(message_ids))
+        return [mid for mid in message_ids if mid in kept]
+
+    def _claiming(self, prefilter, scope):
+        """Metadata check accepting what `prefilter` (if any) accepts, provided this client can claim it in the dedup index."""
+        def accept(metadata):
+            owner = self.account if self.account is not None else self
+            return (prefilter is None or prefilter(metadata)) and self.dedup.claim(scope, metadata, owner)
+        return accept
+
+    def get_emails_for_queries(self, queries, after, only_ids=None, before=None):
+        """
+        Fetch messages for several queries with a single combined list and batch
+        fetch, then route each message to every query whose from/to/subject terms
+        match its headers. A message matching several queries is fetched once and
+        shared between their results.
+
+        All queries must be routable (see GmailQueryMatcher). Returns one list of
+        messages per query, in the same order as `queries`.
+        """
+        routed = [[] for _ in queries]
+        for msg, hits in self.iter_emails_for_queries(queries, after, only_ids=only_ids, before=before):
+            for i in hits:
+                routed[i].append(msg)
+        return routed
+
+    def iter_emails_for_queries(self, queries, after, only_ids=None, prefilters=None, before=None):
+        """
+        Generator version of get_emails_for_queries, yielding (message, indices of matching queries).
+
+        `prefilters` optionally holds one metadata prefilter (or None) per query, see
+        get_emails. A message is fetched in full if any query it is routed to accepts it.
+        """
+        matchers = [GmailQueryMatcher(q) for q in queries]
+
+        prefilter = None
+        if prefilters and any(prefilters):
+            def prefilter(metadata):
+                headers = get_headers(metadata)
+                return any(matcher.matches(headers) and (accept is None or accept(metadata))
+                           for matcher, accept in zip(matchers, prefilters))
+
+        unmatched = 0
+        for msg in self.iter_emails(combine_queries(queries), after, only_ids=only_ids, prefilter=prefilter,
+                                    before=before):
+            hits = [i for i, matcher in enumerate(matchers) if matcher.matches(get_headers(msg))]
+            if hits:
+                yield msg, hits
+            else:
+                unmatched += 1
+
+        if unmatched:
+            self.logger.warning("%d message(s) from the combined query matched no issuer locally.", unmatched)
 
-    def bulk_fetch_messages(self, message_ids, batch_size=100, fmt="full", fields=None,
-                            attempt=0, max_retries=5, initial_delay=1.0):
+    def bulk_fetch_messages(self, message_ids, batch_size=None, fmt="full", fields=None,
+                            max_retries=5, initial_delay=1.0, metadata_headers=None):
         """
         Fetch many Gmail messages using batch requests.
+
+        Takes the same arguments as iter_fetch_messages and returns a list of
+        response dicts (only successful ones included).
+        """
+        return [msg for batch in self.iter_fetch_messages(message_ids, batch_size, fmt, fields, max_retries,
+                                                          initial_delay, metadata_headers)
+                for msg in batch]
+
+    def iter_fetch_messages(self, message_ids, batch_size=None, fmt="full", fields=None,
+                            max_retries=5, initial_delay=1.0, metadata_headers=None):
+        """
+        Fetch many Gmail messages using batch requests, yielding one list of
+        successfully fetched messages per batch so callers never hold more than a
+        batch in memory.
         - message_ids: list of message ids (strings)
-        - batch_size: number of messages per batch (50-100 recommended)
+        - batch_size: fixed number of messages per batch; by default the size adapts
+          to observed rate limiting (see AdaptiveBatchSize)
         - fmt: 'full' | 'metadata' | 'raw' etc.
         - fields: optional fields string to reduce payload size
-        - max_retries: max number of retries per batch on rate limit errors
+        - max_retries: max number of retries per message on rate limit errors
         - initial_delay: initial delay in seconds for exponential backoff
+        - metadata_headers: with fmt='metadata', the only headers to return
 
-        Returns list of response dicts (only successful ones included).
+        Batches are paced by the account's quota token bucket. Rate-limited ids go
+        to a retry queue with per-id exponential backoff and are mixed into later
+        batches once due, so the main stream keeps flowing while they wait.
         """
-        results = {}
+        if self.cache:
+            variant = cache_variant(fmt, fields, metadata_headers)
+            missing = []
+            hits = 0
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                cached = self.cache.get_messages(chunk, variant)
+                missing.extend(mid for mid in chunk if mid not in cached)
+                if cached:
+                    hits += len(cached)
+                    yield list(cached.values())
+            if hits:
+                self.logger.info("Cache hit for %d of %d message(s).", hits, len(message_ids))
+            metrics.inc("cache_hits_total", hits)
+            metrics.inc("cache_misses_total", len(missing))
+            message_ids = missing
+
+        pending = deque(message_ids)
+        retry_queue = []  # heap of (due time, sequence, message id)
+        attempts = defaultdict(int)
         rate_limited_ids = []
+        answered = set()
+        fetched = []
 
         def batch_callback(request_id, response, exception):
+            answered.add(request_id)
             if exception:
-                is_rate_limit = (
-                    isinstance(exception, HttpError)
-                    and exception.resp.status in (429, 403)
-                    and ('rateLimitExceeded' in str(exception) or 'userRateLimitExceeded' in str(exception))
-                )
-                if is_rate_limit:
+                if self._is_rate_limit(exception):
                     rate_limited_ids.append(request_id)
                 else:
                     self.logger.warning("Error fetching message %s: exception=%s, response=%s", request_id, exception, response)
-                    results[request_id] = {"error": exception}
+                    metrics.inc("fetch_failures_total")
             else:
-                results[request_id] = response
+                fetched.append(response)
 
         def _build_request(mid):
+            kwargs = {}
             if fields:
-                return self.client.users().messages().get(userId="me", id=mid, format=fmt, fields=fields)
-            else:
-                return self.client.users().messages().get(userId="me", id=mid, format=fmt)
+                kwargs["fields"] = fields
+            if metadata_headers:
+                kwargs["metadataHeaders"] = metadata_headers
+            return self.client.users().messages().get(userId="me", id=mid, format=fmt, **kwargs)
 
-        for i in range(0, len(message_ids), batch_size):
-            slice_ids = message_ids[i:i + batch_size]
+        sequence = 0
+        while pending or retry_queue:
+            size = batch_size or self.batch_size.size
+            now = time.monotonic()
 
+            # due retries first, then fill up from the main stream
+            slice_ids = []
+            while retry_queue and retry_queue[0][0] <= now and len(slice_ids) < size:
+                slice_ids.append(heapq.heappop(retry_queue)[2])
+            while pending and len(slice_ids) < size:
+                slice_ids.append(pending.popleft())
+            if not slice_ids:
+                # only retries left and none of them is due yet
+                time.sleep(retry_queue[0][0] - now)
+                continue
+
+            self._spend("messages.get", len(slice_ids))
+            metrics.observe("batch_size", len(slice_ids))
             batch = self.client.new_batch_http_request(callback=batch_callback)
             for mid in slice_ids:
                 batch.add(_build_request(mid), request_id=mid)
             try:
-                batch.execute()
+                with metrics.timer("fetch"):
+                    batch.execute(http=self.http)
             except HttpError as e:
-                self.logger.warning("Batch execute error: %s", e)
-
-        # Retry any rate-limited IDs from this batch with exponential backoff
-        if rate_limited_ids and attempt < max_retries:
-            delay = initial_delay * (2 ** attempt) + random.uniform(0, 1)
-            self.logger.warning(
-                "Rate limit hit for %d message(s) in batch %d/%d. Retry %d/%d in %.1fs...",
-                len(rate_limited_ids),
-                i // batch_size + 1,
-                (len(message_ids) + batch_size - 1) // batch_size,
-                attempt + 1,
-                max_retries,
-                delay,
-            )
-            time.sleep(delay)
-
-            # Recursive retry for rate-limited messages
-            retried = self.bulk_fetch_messages(rate_limited_ids, batch_size=batch_size, fmt=fmt, fields=fields, attempt=attempt + 1)
-            for msg in retried:
-                results[msg["id"]] = msg
-        elif rate_limited_ids:
-            # If still rate-limited after all retries, log them as errors
+                if not self._is_rate_limit(e):
+                    self.logger.warning("Batch execute error: %s", e)
+                else:
+                    # the whole batch was refused, retry every id that got no answer
+                    rate_limited_ids.extend(mid for mid in slice_ids if mid not in answered)
+            answered.clear()
+
+            if not batch_size:
+                self.batch_size.update(len(slice_ids), len(rate_limited_ids))
+
+            if rate_limited_ids:
+                metrics.inc("rate_limited_total", len(rate_limited_ids))
+                # slow the whole mailbox down in proportion to what was refused; the
+                # refused ids themselves wait out their own backoff in the retry queue
+                self.rate_limiter.backoff(initial_delay * len(rate_limited_ids) / len(slice_ids))
+                self.logger.warning(
+                    "Rate limit hit for %d of %d message(s), batch size now %d, %d message(s) still queued.",
+                    len(rate_limited_ids), len(slice_ids), batch_size or self.batch_size.size, len(pending),
+                )
             for mid in rate_limited_ids:
-                self.logger.error("Failed to fetch message %s after %d retries (rate limited)", mid, max_retries)
-                results[mid] = {"error": "rateLimitExceeded after retries"}
+                attempts[mid] += 1
+                if attempts[mid] > max_retries:
+                    # still rate-limited after all retries, log it as an error
+                    self.logger.error("Failed to fetch message %s after %d retries (rate limited)", mid, max_retries)
+                    metrics.inc("fetch_failures_total")
+                    continue
+                metrics.inc("fetch_retries_total")
+                delay = initial_delay * (2 ** (attempts[mid] - 1)) + random.uniform(0, 1)
+                sequence += 1
+                heapq.heappush(retry_queue, (now + delay, sequence, mid))
+            rate_limited_ids.clear()
 
-        # Convert results to list (skip errors)
-        emails = []
-        for entry in results.values():
-            if isinstance(entry, dict) and "error" in entry:
-                continue
-            emails.append(entry)
+            if fetched:
+                metrics.inc("messages_fetched_total", len(fetched))
+                if self.cache:
+                    self.cache.put_messages(fetched, variant)
+                yield fetched
+                fetched = []
+
+    def _spend(self, method, count=1):
+        """Wait until the quota allows `count` requests of `method`, and record them."""
+        self.rate_limiter.acquire(QUOTA_UNITS[method] * count)
+        metrics.api_call(method, count)
 
-        return emails
+    @staticmethod
+    def _is_rate_limit(exception):
+        return (
+            isinstance(exception, HttpError)
+            and exception.resp.status in (429, 403)
+            and ('rateLimitExceeded' in str(exception) or 'userRateLimitExceeded' in str(exception))
+        )
 
     def message_link_from_msg(self, msg):
         """
@@ -1,61 +1,137 @@
 from mailmint.google.base import BaseGoogle, register_scope
 import logging
 
+from mailmint.metrics import metrics
+
 register_scope("https://www.googleapis.com/auth/spreadsheets")
 
 
+def column_letter(n):
+    """1 -> A, 26 -> Z, 27 -> AA"""
+    letters = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def sheet_range(sheet_name, start, end=""):
+    # quote the sheet name so titles like 2025-01 are never read as a range
+    return "'{}'!{}{}".format(sheet_name.replace("'", "''"), start, f":{end}" if end else "")
+
+
+def _cell(value):
+    # the Sheets API omits empty trailing cells and returns no value for blanks
+    return "" if value is None else value
+
+
+def changed_blocks(current, rows, width):
+    """
+    Compare the rows currently in a sheet with the rows that should be there and
+    return [(first row index, rows)] blocks covering only what differs. Rows that
+    no longer exist are overwritten with blanks.
+    """
+    blank = [""] * width
+    target = [[_cell(v) for v in row] + [""] * (width - len(row)) for row in rows]
+    target += [blank] * (len(current) - len(rows))
+
+    blocks = []
+    for idx, row in enumerate(target):
+        existing = current[idx] if idx < len(current) else None
+        if existing is not None:
+            existing = list(existing) + [""] * (width - len(existing))
+            if existing[:width] == row:
+                continue
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == idx:
+            blocks[-1][1].append(row)
+        else:
+            blocks.append((idx, [row]))
+    return blocks
+
+
 class GSheet(BaseGoogle):
-    def __init__(self, creds="credentials.json", token="token_gmail.pickle"):
-        super().__init__("sheets", "v4", creds, token)
+    def __init__(self, creds="credentials.json", token="token_gmail.pickle", credentials=None, root_url=None):
+        super().__init__("sheets", "v4", creds, token, credentials, root_url)
         # instance logger
         self.logger = logging.getLogger(__name__)
 
+    def aio(self, http2=True):
+        """Async client for these sheets (mailmint.google.aio.AsyncGSheet), needs httpx."""
+        from mailmint.google.aio import AsyncGSheet
+        return AsyncGSheet(self, http2=http2)
+
     def ensure_sheet(self, spreadsheet_id, sheet_name, template_sheet="Template"):
-        # create sheet_name if not exists
-        existing_sheets = self.client.spreadsheets().get(spreadsheetId=spreadsheet_id).execute().get("sheets", [])
-
-        # Duplicate an existing 'Template' sheet unless existing sheet_name is found.
-        template = None
-        for s in existing_sheets:
-            props = s.get("properties", {})
-            title = props.get("title")
-            if title == sheet_name:
-                return
-            elif title == template_sheet:
-                template = props
+        self.ensure_sheets(spreadsheet_id, [sheet_name], template_sheet)
+
+    def ensure_sheets(self, spreadsheet_id, sheet_names, template_sheet="Template"):
+        """Create every missing sheet as a copy of `template_sheet`, in a single batchUpdate."""
+        metrics.api_call("spreadsheets.get")
+        existing_sheets = self.client.spreadsheets().get(
+            spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)"
+        ).execute(http=self.http).get("sheets", [])
+        titles = {s["properties"]["title"]: s["properties"] for s in existing_sheets}
+
+        missing = [name for name in sheet_names if name not in titles]
+        if not missing:
+            return
 
+        # Duplicate an existing 'Template' sheet for every sheet_name not found.
+        template = titles.get(template_sheet)
         if not template:
-            raise("Template sheet '{teamplate_sheet}' not found")
+            raise ValueError(f"Template sheet '{template_sheet}' not found")
 
-        template_id = template["sheetId"]
+        metrics.api_call("spreadsheets.batchUpdate")
         self.client.spreadsheets().batchUpdate(
             spreadsheetId=spreadsheet_id,
             body={
                 "requests": [{
                     "duplicateSheet": {
-                        "sourceSheetId": template_id,
-                        "newSheetName": sheet_name
+                        "sourceSheetId": template["sheetId"],
+                        "newSheetName": name
                     }
-                }]
+                } for name in missing]
             }
-        ).execute()
+        ).execute(http=self.http)
+        self.logger.info("Created sheets: %s", ", ".join(missing))
 
     def write_to_spreadsheet(self, spreadsheet_id, sheet_name, sheet_data, template_sheet="Template"):
-        if not sheet_data:
+        self.write_sheets(spreadsheet_id, {sheet_name: sheet_data}, template_sheet)
+
+    def write_sheets(self, spreadsheet_id, sheets, template_sheet="Template"):
+        """
+        Write rows (starting at row 2) to several sheets in four round trips in
+        total: read sheet titles, create all missing sheets, read all current
+        values, then write only the rows that changed.
+        - sheets: dict (or iterable of pairs) of sheet name -> list of rows
+        """
+        sheets = {name: rows for name, rows in dict(sheets).items() if rows}
+        if not sheets:
             return
 
-        self.ensure_sheet(spreadsheet_id, sheet_name, template_sheet)
+        self.ensure_sheets(spreadsheet_id, list(sheets), template_sheet)
 
-        # clear 1000 rows of the sheet before writing new data (adjust as needed)
-        self.client.spreadsheets().values().clear(
+        widths = {name: max(len(row) for row in rows) for name, rows in sheets.items()}
+        metrics.api_call("values.batchGet")
+        current = self.client.spreadsheets().values().batchGet(
             spreadsheetId=spreadsheet_id,
-            range=f"{sheet_name}!A2:{chr(64 + len(sheet_data[0]))}1000"
-        ).execute()
+            ranges=[sheet_range(name, "A2", column_letter(widths[name])) for name in sheets],
+            valueRenderOption="UNFORMATTED_VALUE",
+        ).execute(http=self.http).get("valueRanges", [])
+
+        data = []
+        for (name, rows), value_range in zip(sheets.items(), current):
+            blocks = changed_blocks(value_range.get("values", []), rows, widths[name])
+            for start, block in blocks:
+                data.append({"range": sheet_range(name, f"A{start + 2}"), "values": block})
+            self.logger.info("Sheet %s: %d rows, %d changed.", name, len(rows), sum(len(b) for _, b in blocks))
+
+        if not data:
+            self.logger.info("All %d sheet(s) already up to date.", len(sheets))
+            return
 
-        self.client.spreadsheets().values().update(
+        metrics.api_call("values.batchUpdate")
+        self.client.spreadsheets().values().batchUpdate(
             spreadsheetId=spreadsheet_id,
-            range=f"{sheet_name}!A2",
-            valueInputOption="RAW",
-            body={"values": sheet_data}
-        ).execute()
-        self.logger.info("Written %d rows to sheet %s.", len(sheet_data), sheet_name)
+            body={"valueInputOption": "RAW", "data": data},
+        ).execute(http=self.http)
+        self.logger.info("Written %d changed range(s) across %d sheet(s).", len(data), len(sheets))
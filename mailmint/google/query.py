@@ -0,0 +1,87 @@
+import re
+
+# optional "-", optional "operator:", then a "quoted phrase", an (a OR b) / {a b} group or a bare word
+_TERM_RE = re.compile(r'\s*(-?)(?:(\w+):)?("[^"]*"|\([^)]*\)|\{[^}]*\}|[^\s(){}]+)')
+
+# query operators that can be evaluated against message headers
+HEADER_OPERATORS = {"from", "to", "cc", "subject"}
+
+
+def _normalise(text):
+    return " ".join(text.lower().split())
+
+
+class GmailQueryMatcher:
+    """
+    Local approximation of a Gmail search query, evaluated against message headers.
+
+    Only queries made of from:/to:/cc:/subject: terms (optionally negated, quoted or
+    with (a OR b) / {a b} alternatives) are supported; anything else -- body words,
+    labels, has:, top-level OR -- marks the matcher as not `routable` and the query
+    has to be sent to Gmail on its own. Values match as case-insensitive substrings
+    of the header, which is how a combined query's results are routed back to the
+    issuers that asked for them.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.terms = []
+        self.routable = True
+
+        query = query.strip()
+        pos = 0
+        while pos < len(query):
+            m = _TERM_RE.match(query, pos)
+            if not m:
+                self.routable = False
+                break
+            pos = m.end()
+            negate, operator, value = m.groups()
+            if not operator or operator.lower() not in HEADER_OPERATORS:
+                self.routable = False
+                continue
+            alternatives = self._alternatives(value)
+            if not alternatives:
+                self.routable = False
+                continue
+            self.terms.append((bool(negate), operator.lower(), alternatives))
+
+        if not self.terms:
+            self.routable = False
+
+    def _alternatives(self, value):
+        if value.startswith('"'):
+            return [_normalise(value.strip('"'))]
+        if value.startswith("("):
+            alternatives = re.split(r"\s+OR\s+", value[1:-1].strip())
+        elif value.startswith("{"):
+            alternatives = re.findall(r'"[^"]*"|\S+', value[1:-1])
+        else:
+            return [_normalise(value)]
+
+        result = []
+        for alt in alternatives:
+            if alt.startswith('"'):
+                result.append(_normalise(alt.strip('"')))
+            elif " " in alt.strip():
+                # "(a b)" means a AND b, which we don't evaluate locally
+                return []
+            else:
+                result.append(_normalise(alt))
+        return result
+
+    def matches(self, headers):
+        """
+        headers: dict of lowercase header name -> value (see mailmint.helpers.get_headers)
+        """
+        for negate, operator, alternatives in self.terms:
+            value = _normalise(headers.get(operator, ""))
+            found = any(alt in value for alt in alternatives)
+            if found == negate:
+                return False
+        return True
+
+
+def combine_queries(queries):
+    """OR several Gmail queries into one."""
+    return "(" + " OR ".join(f"({q})" for q in queries) + ")"
@@ -0,0 +1,100 @@
+import threading
+import time
+
+# Gmail API quota units per method, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "watch": 100,
+}
+
+# per-user limit on quota units per second
+GMAIL_USER_QUOTA_PER_SECOND = 250
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket measured in quota units.
+
+    One bucket is shared by every thread talking to the same mailbox, so together
+    they stay under the per-user quota instead of each thread discovering it via 429s.
+    """
+
+    def __init__(self, rate=GMAIL_USER_QUOTA_PER_SECOND, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units):
+        """Block until `units` tokens are available and take them.
+
+        More than `capacity` units (e.g. a full batch) are taken in capacity-sized
+        slices, so large requests pay in full and wait for the refill.
+        """
+        while units > 0:
+            part = min(units, self.capacity)
+            while True:
+                wait = self.take(part)
+                if not wait:
+                    break
+                time.sleep(wait)
+            units -= part
+
+    def take(self, units):
+        """Take `units` tokens if available and return 0, else return the seconds to wait before trying again.
+
+        Lets callers that must not block, e.g. coroutines, wait their own way.
+        `units` must not exceed `capacity`; acquire() splits larger amounts.
+        """
+        if units > self.capacity:
+            raise ValueError(f"Cannot take {units} units at once from a bucket of capacity {self.capacity}")
+        with self.lock:
+            self._refill()
+            if self.tokens >= units:
+                self.tokens -= units
+                return 0
+            return (units - self.tokens) / self.rate
+
+    def backoff(self, seconds):
+        """Take `seconds` worth of refill out of the bucket, going into debt if needed, e.g. after the server rate limited us.
+
+        Callers scale `seconds` to how much of their traffic was refused, so a
+        few rate-limited requests cost a little pacing rather than a full stall.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= seconds * self.rate
+
+
+class AdaptiveBatchSize:
+    """
+    Additive-increase / multiplicative-decrease batch size.
+
+    Grows by `step` after every batch without rate limiting and halves whenever
+    more than `tolerance` of a batch was rate limited.
+    """
+
+    def __init__(self, initial=50, minimum=5, maximum=100, step=5, tolerance=0.05):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+
+    def update(self, sent, rate_limited):
+        with self.lock:
+            if rate_limited > sent * self.tolerance:
+                self.size = max(self.minimum, self.size // 2)
+            elif not rate_limited:
+                self.size = min(self.maximum, self.size + self.step)
+            return self.size
@@ -1,32 +1,129 @@
 import base64
+import codecs
+import html
+import re
 
-def get_html_body(payload):
-    # mime = payload.get("mimeType")
-    data = payload.get("body", {}).get("data")
-    return base64.urlsafe_b64decode(data).decode("utf-8") if data else ""
-    # if mime == "text/html" and data:
-    #     return base64.urlsafe_b64decode(data).decode("utf-8")
+# tags that end a line of text when rendered
+_LINE_BREAK_RE = re.compile(r"<br\s*/?>|</?(?:p|div|tr|li|table|h[1-6])(?:\s[^>]*)?>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]*>")
+_SPACES_RE = re.compile(r"[ \t\r\f\v\xa0]+")
+_CHARSET_RE = re.compile(r"""charset\s*=\s*["']?([^"';\s]+)""", re.IGNORECASE)
 
-    # return ""
+# bump when a change here alters the body or text view parsers get for the same
+# message, so cached parse results are not reused (see BaseIssuerParser.config_hash)
+# 2: walk nested MIME parts, decode only the chosen part with its declared charset
+# 3: parts nested deeper than three levels are fetched, see mailmint.google.gmail.FULL_FIELDS
+DECODE_VERSION = 3
+
+# preferred MIME types for each `body_type` an issuer can ask for
+BODY_TYPES = {
+    "html": ("text/html", "text/plain"),
+    "plain": ("text/plain", "text/html"),
+}
+
+def iter_parts(payload):
+    """Yield every part of a Gmail message payload, itself included, depth first in document order.
+
+    Walks with an explicit stack, so arbitrarily deep multipart trees are fine.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get("parts") or []))
+
+def part_charset(part):
+    """Charset from the part's Content-Type header, utf-8 if it has none or an unknown one."""
+    for header in part.get("headers", []):
+        if header.get("name", "").lower() == "content-type":
+            charset = _CHARSET_RE.search(header.get("value", ""))
+            if charset:
+                try:
+                    return codecs.lookup(charset.group(1)).name
+                except LookupError:
+                    break
+    return "utf-8"
+
+def decode_part(part):
+    """Base64-decode a part's body data and decode it with the part's charset."""
+    data = part.get("body", {}).get("data")
+    if not data:
+        return ""
+    return base64.urlsafe_b64decode(data).decode(part_charset(part), errors="replace")
+
+def select_body_part(payload, body_type="html"):
+    """
+    Return the part holding the message's body: the first part of the most preferred
+    MIME type for `body_type` (see BODY_TYPES) that has body data, else the first part
+    with any body data (e.g. a bare message without a mimeType), else None.
+    """
+    preferred = BODY_TYPES[body_type]
+    best = best_rank = None
+    for part in iter_parts(payload):
+        if not part.get("body", {}).get("data"):
+            continue
+        mime = (part.get("mimeType") or "").lower()
+        rank = preferred.index(mime) if mime in preferred else len(preferred)
+        if best_rank is None or rank < best_rank:
+            best, best_rank = part, rank
+            if rank == 0:
+                break
+    return best
+
+def get_email_body(msg, body_type="html"):
+    """
+    Decoded body of the message as chosen by select_body_part, or "". Only that part
+    is decoded, once per message and body type: the result is memoised on the
+    message dict, so every stage and parser shares it.
+    """
+    bodies = msg.setdefault("_bodies", {})
+    body = bodies.get(body_type)
+    if body is None:
+        part = select_body_part(msg.get("payload", {}), body_type)
+        body = bodies[body_type] = decode_part(part) if part else ""
+    return body
 
 def get_email_html(msg):
-    payload = msg.get("payload", {})
-
-    html_body = get_html_body(payload)
-    # Some messages put HTML in body->data directly when no parts
-    if html_body:
-        return html_body
-
-    for part in payload.get("parts", []):
-        html_body = get_html_body(part)
-        if html_body:
-            return html_body
-
-        # fallback: sometimes nested parts
-        if mime == "multipart/alternative":
-            for sub in part.get("parts", []):
-                html_body = get_html_body(sub)
-                if html_body:
-                    return html_body
-
-    return ""
+    """The message's HTML body, or its plain text body if it has no HTML part."""
+    return get_email_body(msg, "html")
+
+def _view(msg, kind, body, compute):
+    # views of a body are memoised per body: str caches its hash, so the lookup is cheap
+    views = msg.setdefault("_views", {})
+    key = (kind, body)
+    value = views.get(key)
+    if value is None:
+        value = views[key] = compute(body)
+    return value
+
+def get_email_lower(msg, body=None):
+    """Lowercased view of the message's body (or of `body`, a body of it), memoised on the message."""
+    if body is None:
+        body = get_email_html(msg)
+    return _view(msg, "lower", body, str.lower)
+
+def get_headers(msg):
+    """Return the message's top-level headers as a dict of lowercase name -> value."""
+    headers = msg.get("payload", {}).get("headers", [])
+    return {h.get("name", "").lower(): h.get("value", "") for h in headers}
+
+def html_to_text(html_body):
+    """
+    Normalised plain-text view of an HTML email: line-breaking tags become
+    newlines, all other tags are stripped, entities are decoded and runs of
+    spaces collapsed. Blank lines are dropped and every line is stripped.
+    """
+    text = _LINE_BREAK_RE.sub("\n", html_body)
+    text = html.unescape(_TAG_RE.sub("", text))
+    lines = (_SPACES_RE.sub(" ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def get_email_text(msg, html_body=None):
+    """
+    Return html_to_text() of the message's HTML body (or of `html_body`, a body of
+    it), computed once per message and body and memoised on the message dict so
+    every parser shares it.
+    """
+    if html_body is None:
+        html_body = get_email_html(msg)
+    return _view(msg, "text", html_body, html_to_text)
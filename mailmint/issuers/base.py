@@ -1,16 +1,105 @@
 import re
+import html
+import json
+import hashlib
+from datetime import datetime
+
+from mailmint.issuers.matcher import PatternMatcher
+from mailmint.helpers import BODY_TYPES, DECODE_VERSION, get_email_lower, get_email_text, get_headers
+from mailmint.metrics import metrics
+
+# an email without any of these is not a transaction alert
+DEFAULT_REQUIRED_KEYWORDS = ["inr", "rs."]
+
+# metadata_filter fields; each takes `<field>` (must contain one of) and `exclude_<field>` lists
+METADATA_FILTER_FIELDS = ("snippet", "from", "subject")
 
 class BaseIssuerParser:
+    # bump when a change to the parser alters its output for the same config and
+    # message, so cached parse results are not reused (see config_hash)
+    parse_version = 1
+
     def __init__(self, issuer_config):
         self.config = issuer_config
         self.name = issuer_config.get("name", "Unknown Issuer")
 
         self.patterns = []
-        for pattern_entry in self.config.get("patterns", []):
+        for index, pattern_entry in enumerate(self.config.get("patterns", [])):
             self.patterns.append({
                 "pattern": re.compile(pattern_entry["pattern"]),
                 "direction": pattern_entry["direction"],
+                "index": index,
             })
+        self.matcher = PatternMatcher(self.patterns, self.config.get("required_keywords", DEFAULT_REQUIRED_KEYWORDS))
+        self.metadata_filter = self._compile_metadata_filter(self.config.get("metadata_filter") or {})
+        # which MIME part is the email body, see mailmint.helpers.select_body_part
+        self.body_type = self.config.get("body_type", "html")
+        if self.body_type not in BODY_TYPES:
+            raise ValueError(f"Unknown body_type '{self.body_type}' for issuer: {self.name}")
+
+        # identifies this parser's behaviour, e.g. for caching parse results
+        fingerprint = json.dumps(
+            {"class": f"{type(self).__module__}.{type(self).__qualname__}", "config": self.config,
+             "parse_version": self.parse_version, "decode_version": DECODE_VERSION},
+            sort_keys=True, default=str,
+        )
+        self.config_hash = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def _compile_metadata_filter(self, rules):
+        compiled = {}
+        for key, values in rules.items():
+            if key == "since":
+                compiled[key] = datetime.strptime(str(values), "%Y-%m-%d").timestamp() * 1000
+            elif key.removeprefix("exclude_") in METADATA_FILTER_FIELDS:
+                compiled[key] = [v.lower() for v in values]
+            else:
+                raise ValueError(f"Unknown metadata_filter key '{key}' for issuer: {self.name}")
+        return compiled
+
+    def accepts_metadata(self, email_metadata):
+        """
+        Cheap precheck on a message's snippet, headers and internalDate, run before
+        its body is downloaded when the issuer config has a `metadata_filter`.
+        Messages failing it are never fetched in full.
+        """
+        rules = self.metadata_filter
+        if not rules:
+            return True
+
+        since = rules.get("since")
+        if since and int(email_metadata.get("internalDate", 0)) < since:
+            return False
+
+        headers = get_headers(email_metadata)
+        values = {
+            "snippet": html.unescape(email_metadata.get("snippet", "")),
+            "from": headers.get("from", ""),
+            "subject": headers.get("subject", ""),
+        }
+        for field, value in values.items():
+            value = value.lower()
+            wanted = rules.get(field)
+            if wanted and not any(w in value for w in wanted):
+                return False
+            if any(unwanted in value for unwanted in rules.get("exclude_" + field, ())):
+                return False
+        return True
+
+    def has_required_keywords(self, email_body_html, email_metadata=None):
+        """Cheap precheck run before parse_email_body; emails failing it are skipped.
+
+        With `email_metadata`, the message's memoised lowercased view is used.
+        """
+        if email_metadata is None:
+            return self.matcher.has_keywords(email_body_html)
+        return self.matcher.has_keywords(email_body_html, lambda body: get_email_lower(email_metadata, body))
+
+    def email_text(self, email_body_html, email_metadata):
+        """
+        Normalised plain-text view of the email (tags stripped, <br> as line breaks,
+        entities decoded). Computed once per message and shared by every parser.
+        """
+        return get_email_text(email_metadata, email_body_html)
 
     def parse_email_body(self, email_body_html, email_metadata):
         """
@@ -18,19 +107,26 @@ class BaseIssuerParser:
         - amount
         - merchant
         - account name
+
+        Patterns run against the raw HTML, or against email_text() if the issuer
+        config sets `match_text: true`.
         """
         if not self.patterns:
             raise NotImplementedError
 
-        for pattern_entry in self.patterns:
-            pattern = pattern_entry["pattern"]
+        body = email_body_html
+        if self.config.get("match_text", False):
+            body = self.email_text(email_body_html, email_metadata)
+
+        pattern_entry, data = self.matcher.search(body, lambda body: get_email_lower(email_metadata, body))
+        if data:
+            metrics.inc("pattern_hits_total", issuer=self.name, pattern=pattern_entry["index"])
             direction = pattern_entry["direction"]
-            data = pattern.search(email_body_html)
-            if data:
-                return {
-                    "amount": direction * float(data.group("amount").replace(",", "")),
-                    "merchant": data.group("merchant").strip(),
-                    "account": self.name + " xx" + data.group("account"),
-                }
+            return {
+                "amount": direction * float(data.group("amount").replace(",", "")),
+                "merchant": data.group("merchant").strip(),
+                "account": self.name + " xx" + data.group("account"),
+            }
 
+        metrics.inc("pattern_misses_total", issuer=self.name)
         return {}
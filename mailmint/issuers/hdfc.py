@@ -1,28 +1,28 @@
 import re
 from mailmint.issuers.base import BaseIssuerParser
 
+# amount, direction and account of an alert; without DOTALL `.` stays within a line of the text view
+ALERT_RE = re.compile(r"Rs\.\s*(INR\s*)?(?P<rs>[0-9,]+)(?P<ps>\.\d{1,2})?.*(?P<dir>[Ff]rom|to) .*(XX|\*\*)(?P<acc>\d{4})")
+ALERT_DOTALL_RE = re.compile(ALERT_RE.pattern, re.DOTALL)
+
+# the merchant follows the account, up to the end of the sentence or line
+MERCHANT_RE = re.compile(r"\s*(.*?)(?:\. |$)", re.MULTILINE)
+DATE_SUFFIX_RE = re.compile(r" on \d{2}-")
+DROP_PHRASE_RES = [
+    re.compile(r"^(from|by) ", re.IGNORECASE),
+    re.compile(r"^(for|to|on account of)( a)? ", re.IGNORECASE),
+]
+
 
 class HDFCBankParser(BaseIssuerParser):
-    def parse_email_body(self, email_body_html, email_metadata):
-        line_patterns = [
-            r"Rs\.\s*(INR\s*)?(?P<rs>[0-9,]+)(?P<ps>\.\d{1,2})?.*(?P<dir>[Ff]rom|to) .*(XX|\*\*)(?P<acc>\d{4})(<br>)?"
-        ]
-        data = None
-        for l in email_body_html.splitlines():
-            l = l.strip()
-            for lp in line_patterns:
-                data = re.search(lp, l)
-                if data:
-                    break
-            if data:
-                break
+    # 2: runs on the html_to_text view, so merchants have entities decoded and keep text after inline tags
+    parse_version = 2
 
-        if not data:
-            for lp in line_patterns:
-                data = re.search(lp, email_body_html, re.DOTALL)
-                if data:
-                    break
+    def parse_email_body(self, email_body_html, email_metadata):
+        text = self.email_text(email_body_html, email_metadata)
 
+        # first match within a single line, then allow the alert to span lines
+        data = ALERT_RE.search(text) or ALERT_DOTALL_RE.search(text)
         if not data:
             return {}
 
@@ -35,15 +35,10 @@ class HDFCBankParser(BaseIssuerParser):
             amount = -amount
         account = "HDFC Bank account xx" + data.group("acc")
 
-        meta = data.string[data.end():].strip()
-        meta = re.split(r"(\. )|<", meta)[0].strip()
-        meta = re.split(r" on \d{2}-", meta)[0].strip()
-        drop_phrases = [
-            r"^(from|by) ",
-            r"^(for|to|on account of)( a)? ",
-        ]
-        for dp in drop_phrases:
-            meta = re.sub(dp, "", meta, flags=re.IGNORECASE).strip()
+        meta = MERCHANT_RE.match(text, data.end()).group(1).strip()
+        meta = DATE_SUFFIX_RE.split(meta, 1)[0].strip()
+        for dp in DROP_PHRASE_RES:
+            meta = dp.sub("", meta).strip()
 
         return {
             "amount": amount,
@@ -0,0 +1,192 @@
+import functools
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+_GROUP_RE = re.compile(r"\(\?P([<=])(\w+)")
+
+
+@functools.lru_cache(maxsize=64)
+def lowered(text):
+    """Lowercased view of an email body, computed once per body however many checks use it."""
+    return text.lower()
+
+
+def literal_anchor(pattern):
+    """
+    Return the longest run of literal characters that every match of the compiled
+    `pattern` must contain, lowercased, or "" if there is none.
+
+    Used as a cheap substring prefilter: if the anchor is absent from the body the
+    regex cannot match and is not run at all.
+    """
+    best = ""
+    run = []
+
+    def walk(items):
+        nonlocal best
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                run.append(chr(av))
+                continue
+            if op == sre_parse.SUBPATTERN:
+                # a group is mandatory, its literals continue the surrounding run
+                walk(av[-1])
+                continue
+            if len(run) > len(best):
+                best = "".join(run)
+            run.clear()
+
+    walk(sre_parse.parse(pattern.pattern, pattern.flags))
+    if len(run) > len(best):
+        best = "".join(run)
+    return best.lower()
+
+
+def combine_patterns(patterns):
+    """
+    Compile patterns into one alternation, each branch ending in an empty
+    `_p<index>` tag group and with its named groups prefixed so they don't clash.
+    Returns None if the patterns can't share one regex (numbered backreferences,
+    inline global flags, differing compile flags).
+    """
+    if not patterns or len({p.flags for p in patterns}) > 1:
+        return None
+    branches = []
+    for i, pattern in enumerate(patterns):
+        if re.search(r"\\[1-9]|^\(\?[a-zA-Z]+\)", pattern.pattern):
+            return None
+        source = _GROUP_RE.sub(lambda m, i=i: f"(?P{m.group(1)}_p{i}_{m.group(2)}", pattern.pattern)
+        # tag goes last so every branch still starts with its own literal prefix,
+        # which lets the regex engine skip ahead to candidate positions
+        branches.append(f"(?:{source})(?P<_p{i}>)")
+    try:
+        return re.compile("|".join(branches), patterns[0].flags)
+    except re.error:
+        return None
+
+
+def branch_offsets(patterns):
+    """Group number just before each pattern's first group in combine_patterns(patterns)."""
+    offsets, offset = [], 0
+    for pattern in patterns:
+        offsets.append(offset)
+        offset += pattern.groups + 1  # its own groups, then its tag
+    return offsets
+
+
+class BranchMatch:
+    """
+    The match of one branch of a combined alternation, seen as a match of that
+    branch's own pattern: group numbers and names are those of the pattern.
+    """
+
+    def __init__(self, match, pattern, offset):
+        self.match = match
+        self.re = pattern
+        self.offset = offset
+        self.string = match.string
+
+    def _group(self, group):
+        if isinstance(group, str):
+            group = self.re.groupindex[group]
+        return self.offset + group if group else 0
+
+    def group(self, *groups):
+        if len(groups) > 1:
+            return tuple(self.match.group(self._group(g)) for g in groups)
+        return self.match.group(self._group(groups[0] if groups else 0))
+
+    __getitem__ = group
+
+    def groups(self, default=None):
+        values = (self.match.group(self.offset + n) for n in range(1, self.re.groups + 1))
+        return tuple(default if value is None else value for value in values)
+
+    def groupdict(self, default=None):
+        values = {name: self.group(name) for name in self.re.groupindex}
+        return {name: default if value is None else value for name, value in values.items()}
+
+    def start(self, group=0):
+        return self.match.start(self._group(group))
+
+    def end(self, group=0):
+        return self.match.end(self._group(group))
+
+    def span(self, group=0):
+        return self.match.span(self._group(group))
+
+
+class PatternMatcher:
+    """
+    Single-pass matcher over an issuer's required keywords and patterns.
+
+    The keyword precheck runs against one lowercased view of the body. A single
+    pattern is searched directly. Several are combined into a tagged alternation,
+    so the body is scanned about twice however many patterns there are, while
+    configured order still decides which pattern wins; the winner's groups are
+    read from the combined match (see BranchMatch). Patterns that can't be
+    combined fall back to running one by one behind a literal-anchor substring
+    prefilter.
+    """
+
+    def __init__(self, patterns, keywords):
+        self.patterns = patterns
+        self.keywords = [kw.lower() for kw in keywords]
+        compiled = [entry["pattern"] for entry in patterns]
+        # alternations of the first n patterns, keyed by n and built on demand
+        self.combined = {len(patterns): combine_patterns(compiled) if len(patterns) > 1 else None}
+        self.offsets = branch_offsets(compiled)
+        self.anchors = [literal_anchor(pattern) for pattern in compiled]
+
+    def _combined(self, n):
+        if n not in self.combined:
+            self.combined[n] = combine_patterns([entry["pattern"] for entry in self.patterns[:n]])
+        return self.combined[n]
+
+    def has_keywords(self, body, lower=lowered):
+        """`lower(body)` returns the body's lowercased view, e.g. one memoised by the caller."""
+        text = lower(body)
+        return any(kw in text for kw in self.keywords)
+
+    def search(self, body, lower=lowered):
+        """Return (pattern entry, match) for the first configured pattern that matches, or (None, None).
+
+        `lower` is as for has_keywords, and only called if the patterns can't be combined.
+        """
+        if len(self.patterns) == 1:
+            entry = self.patterns[0]
+            data = entry["pattern"].search(body)
+            return (entry, data) if data else (None, None)
+        if self.combined[len(self.patterns)] is None:
+            return self._search_each(body, lower)
+
+        winner = match = None
+        limit, pos = len(self.patterns), 0
+        while limit:
+            data = self._combined(limit).search(body, pos)
+            if not data:
+                break
+            # The alternation returns the leftmost match. Patterns after the winner
+            # can no longer win; those before it failed at every position up to
+            # here but may still match further on, and would take precedence.
+            winner, match = int(data.lastgroup[2:]), data
+            limit, pos = winner, data.start() + 1
+
+        if winner is None:
+            return None, None
+        entry = self.patterns[winner]
+        return entry, BranchMatch(match, entry["pattern"], self.offsets[winner])
+
+    def _search_each(self, body, lower):
+        text = lower(body)
+        for entry, anchor in zip(self.patterns, self.anchors):
+            if anchor not in text:
+                continue
+            data = entry["pattern"].search(body)
+            if data:
+                return entry, data
+        return None, None
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import logging
+
+from mailmint.dedup import transaction_key
+
+logger = logging.getLogger(__name__)
+
+
+def compile_exclusions(merchants):
+    """
+    One regex matching a lowercased merchant that contains any of `merchants`
+    (the issuer's notify_exclude_merchants), or None if there are none.
+    """
+    if not merchants:
+        return None
+    return re.compile("|".join(re.escape(m) for m in merchants))
+
+
+class BalanceLedger:
+    """
+    Persistent running balances per month and account for `notify_balance`
+    issuers, stored as a JSON file:
+
+      {"version": 2,
+       "months": {<YYYY-MM>: {"totals": {<account>: sum of amounts},
+                              "seen": {<issuer>: {<transaction key>: [account, counted amount]}}}},
+       "exclusions": {<issuer>: notify_exclude_merchants the seen amounts were counted with},
+       "notified": {<YYYY-MM>: {<account>: last balance sent}}}
+
+    add() only looks at transactions it hasn't seen (or whose amount changed), so
+    the totals are kept up to date without summing the month again. Transactions
+    are keyed by mailmint.dedup.transaction_key, so the same alert kept by two
+    accounts is counted once.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"version": self.VERSION, "months": {}, "exclusions": {}, "notified": {}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        if self.data.get("version") != self.VERSION:
+            # counted under message ids; recount from the transactions of the next run
+            logger.info("Recounting balances in %s by email fingerprint.", path)
+            self.data.update(version=self.VERSION, months={})
+        self.excludes = {}  # issuer name -> compiled exclusions
+
+    def _exclusions(self, issuer):
+        name = issuer.get("name")
+        merchants = issuer.get("notify_exclude_merchants", [])
+        if self.data["exclusions"].get(name, []) != merchants:
+            # counted with other exclusions, recount this issuer's transactions as they come in
+            self._forget_issuer(name)
+            self.data["exclusions"][name] = merchants
+            self.excludes.pop(name, None)
+        if name not in self.excludes:
+            self.excludes[name] = compile_exclusions(merchants)
+        return self.excludes[name]
+
+    def _forget_issuer(self, name):
+        for month in self.data["months"].values():
+            for account, amount in month["seen"].pop(name, {}).values():
+                month["totals"][account] -= amount
+
+    def add(self, issuer, transactions):
+        """Count the issuer's new or changed transactions, if it has `notify_balance`. Returns how many changed."""
+        if not issuer.get("notify_balance", False):
+            return 0
+        exclude = self._exclusions(issuer)
+        changed = 0
+        for trx in transactions:
+            month = self.data["months"].setdefault(trx["date"][:7], {"totals": {}, "seen": {}})
+            seen = month["seen"].setdefault(issuer.get("name"), {})
+            excluded = exclude is not None and exclude.search(trx["merchant"].lower())
+            amount = 0.0 if excluded else trx["amount"]
+            key = transaction_key(trx)
+            previous = seen.get(key)
+            if previous == [trx["account"], amount]:
+                continue
+            if excluded:
+                logger.info("Excluding merchant '%s' from balance calculation for account %s.", trx["merchant"], trx["account"])
+            if previous:
+                month["totals"][previous[0]] -= previous[1]
+            seen[key] = [trx["account"], amount]
+            month["totals"][trx["account"]] = month["totals"].get(trx["account"], 0.0) + amount
+            changed += 1
+        return changed
+
+    def balances(self, month):
+        """{account: balance} for `month` (YYYY-MM), positive when debits exceed credits."""
+        totals = self.data["months"].get(month, {}).get("totals", {})
+        return {account: round(-total, 2) for account, total in totals.items()}
+
+    def changed(self, month):
+        """The month's balances if any differs from the last ones sent, else {}."""
+        balances = self.balances(month)
+        return balances if balances != self.data["notified"].get(month) else {}
+
+    def mark_notified(self, month, balances):
+        self.data["notified"][month] = balances
+
+    def prune(self, before):
+        """Forget months before `before` (YYYY-MM)."""
+        for key in ("months", "notified"):
+            self.data[key] = {month: value for month, value in self.data[key].items() if month >= before}
+
+    def save(self):
+        # write atomically, like SyncState
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp, self.path)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from mailmint.google.ratelimit import QUOTA_UNITS
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+def _write_atomic(path, text):
+    # readers (e.g. node_exporter's textfile collector) never see a partial file
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class Metrics:
+    """
+    Thread-safe collector for one run: time spent per stage, counters and
+    observed values, each with optional labels.
+
+    Labels set with scope() apply to everything recorded from the current thread
+    inside the block, e.g. the account a worker is processing. Stage times are
+    summed over threads, so with several workers they can add up to more than
+    the run's wall time.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.stages = defaultdict(lambda: [0.0, 0])  # (stage, labels) -> [seconds, calls]
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.observations = {}  # (name, labels) -> [count, sum, max]
+
+    def _labels(self, labels):
+        scoped = getattr(self.local, "labels", None)
+        return _key(dict(scoped, **labels) if scoped else labels)
+
+    @contextmanager
+    def scope(self, **labels):
+        previous = getattr(self.local, "labels", None)
+        self.local.labels = dict(previous or {}, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, **labels)
+
+    def add_time(self, stage, seconds, **labels):
+        key = (stage, self._labels(labels))
+        with self.lock:
+            entry = self.stages[key]
+            entry[0] += seconds
+            entry[1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            entry = self.observations.get(key)
+            if entry is None:
+                self.observations[key] = [1, value, value]
+            else:
+                entry[0] += 1
+                entry[1] += value
+                entry[2] = max(entry[2], value)
+
+    def merge(self, report):
+        """Add another collector's report() to this one, e.g. one sent back by a worker process."""
+        with self.lock:
+            for s in report["stages"]:
+                entry = self.stages[(s["stage"], _key(s["labels"]))]
+                entry[0] += s["seconds"]
+                entry[1] += s["calls"]
+            for c in report["counters"]:
+                self.counters[(c["name"], _key(c["labels"]))] += c["value"]
+            for o in report["observations"]:
+                key = (o["name"], _key(o["labels"]))
+                entry = self.observations.get(key)
+                if entry is None:
+                    self.observations[key] = [o["count"], o["sum"], o["max"]]
+                else:
+                    entry[0] += o["count"]
+                    entry[1] += o["sum"]
+                    entry[2] = max(entry[2], o["max"])
+
+    def api_call(self, method, count=1, **labels):
+        """Count `count` Gmail API requests of `method` and the quota units they cost."""
+        self.inc("api_requests_total", count, method=method, **labels)
+        self.inc("quota_units_total", QUOTA_UNITS.get(method, 0) * count, **labels)
+
+    def report(self):
+        """The run's metrics as a JSON-serialisable dict."""
+        with self.lock:
+            return {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "stages": [
+                    {"stage": stage, "labels": dict(key), "seconds": round(seconds, 6), "calls": calls}
+                    for (stage, key), (seconds, calls) in sorted(self.stages.items())
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(key), "value": value}
+                    for (name, key), value in sorted(self.counters.items())
+                ],
+                "observations": [
+                    {"name": name, "labels": dict(key), "count": count, "sum": total, "max": peak}
+                    for (name, key), (count, total, peak) in sorted(self.observations.items())
+                ],
+            }
+
+    def prometheus(self, prefix="mailmint"):
+        """The run's metrics in the Prometheus text exposition format."""
+        report = self.report()
+        lines = [
+            f"# TYPE {prefix}_run_start_timestamp_seconds gauge",
+            f"{prefix}_run_start_timestamp_seconds {self.started:.3f}",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration_seconds']}",
+            f"# TYPE {prefix}_stage_seconds gauge",
+        ]
+        for s in report["stages"]:
+            labels = _prom_labels(_key(dict(s["labels"], stage=s["stage"])))
+            lines.append(f"{prefix}_stage_seconds{labels} {s['seconds']}")
+
+        typed = set()
+        for c in report["counters"]:
+            name = f"{prefix}_{c['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_prom_labels(_key(c['labels']))} {c['value']:g}")
+        for o in report["observations"]:
+            name = f"{prefix}_{o['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} summary")
+            labels = _prom_labels(_key(o["labels"]))
+            lines.append(f"{name}_count{labels} {o['count']}")
+            lines.append(f"{name}_sum{labels} {o['sum']:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.prometheus())
+
+
+# process-wide collector, reset() at the start of a run
+metrics = Metrics()
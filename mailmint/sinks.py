@@ -0,0 +1,118 @@
+import itertools
+import logging
+import sqlite3
+import time
+
+from mailmint.aggregate import SHEET_COLUMNS
+from mailmint.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BaseSink:
+    """
+    Destination for month sheets, given as {month: [(transaction key, row)]} like
+    MonthAggregator.records() yields them.
+
+    write() only buffers; the buffered months are handed to write_months() in
+    one go by flush(), which happens on its own once `flush_rows` rows are
+    buffered, and on close(). Writing a month again before a flush replaces the
+    buffered rows. Subclasses implement write_months().
+    """
+
+    def __init__(self, flush_rows=50000):
+        self.flush_rows = flush_rows
+        self.buffer = {}
+
+    def write(self, months):
+        """Buffer (month, records) pairs, flushing when the buffer is full."""
+        for month, records in dict(months).items():
+            self.buffer[month] = records
+        if sum(len(records) for records in self.buffer.values()) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            buffered, self.buffer = self.buffer, {}
+            self.write_months(buffered)
+
+    def write_months(self, months):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class SheetsSink(BaseSink):
+    """Writes months to their sheets of a Google spreadsheet, see GSheet.write_sheets."""
+
+    def __init__(self, sheets_client, spreadsheet_id, flush_rows=50000):
+        super().__init__(flush_rows)
+        self.sheets_client = sheets_client
+        self.spreadsheet_id = spreadsheet_id
+
+    def write_months(self, months):
+        sheets = {month: [row for _, row in records] for month, records in months.items()}
+        with metrics.timer("sheet_write"):
+            self.sheets_client.write_sheets(self.spreadsheet_id, sheets)
+
+
+class SQLiteSink(BaseSink):
+    """
+    Local append-only SQLite store of transactions, without the row limits and
+    API latency of Google Sheets.
+
+    One `transactions` table holds the SHEET_COLUMNS of every row with its month
+    and its mailmint.dedup.transaction_key (the fingerprint of its email), indexed
+    by month so a range of months is read back like the month sheets. Rows are
+    upserted by that key, like the sync state and the balance ledger: new ones are
+    appended, changed ones (including a copy of the email now kept by another
+    account) are updated in place and unchanged ones are not written at all. Rows
+    are never deleted, so the store keeps months (and transactions) that have left
+    the sync window.
+    """
+
+    def __init__(self, path="transactions.sqlite", flush_rows=50000):
+        super().__init__(flush_rows)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    key TEXT PRIMARY KEY,
+                    month TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    amount REAL,
+                    merchant TEXT,
+                    account TEXT,
+                    category TEXT,
+                    written_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS transactions_month ON transactions (month, date);
+            """)
+        values = ", ".join(f"{column} = excluded.{column}" for column in ("month", *SHEET_COLUMNS, "written_at"))
+        changed = " OR ".join(f"{column} IS NOT excluded.{column}" for column in SHEET_COLUMNS)
+        self.upsert = (f"INSERT INTO transactions (key, month, {', '.join(SHEET_COLUMNS)}, written_at) "
+                       f"VALUES (?, ?, {', '.join('?' * len(SHEET_COLUMNS))}, ?) "
+                       f"ON CONFLICT (key) DO UPDATE SET {values} WHERE {changed}")
+
+    def write_months(self, months):
+        now = time.time()
+        with metrics.timer("store_write"), self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(self.upsert, ((key, month, *row, now)
+                                                for month, records in months.items() for key, row in records))
+            changed = self.conn.total_changes - before
+        logger.info("%s: %d new or changed row(s) in %d month(s).", self.path, changed, len(months))
+
+    def read(self, first_month=None, last_month=None):
+        """Yield (month, [(transaction key, row)]) for the stored months in [first_month, last_month] (YYYY-MM), in month order."""
+        rows = self.conn.execute(
+            f"SELECT month, key, {', '.join(SHEET_COLUMNS)} FROM transactions WHERE month >= ? AND month <= ? "
+            "ORDER BY month, date, rowid", (first_month or "", last_month or "9999-99"))
+        for month, records in itertools.groupby(rows, key=lambda record: record[0]):
+            yield month, [(key, list(row)) for _, key, *row in records]
+
+    def close(self):
+        super().close()
+        self.conn.close()
@@ -0,0 +1,65 @@
+import json
+import os
+import logging
+
+from mailmint.dedup import transaction_key
+
+logger = logging.getLogger(__name__)
+
+
+class SyncState:
+    """
+    Persistent checkpoints for incremental runs, stored as a JSON file:
+
+      {"accounts": {<account>: {"history_id": "...",
+                                "transactions": {<issuer>: {<transaction key>: transaction}}}}}
+
+    Transactions are keyed by mailmint.dedup.transaction_key, i.e. the fingerprint
+    of their email, so the same alert is stored once per account and issuer.
+
+    Transactions parsed in earlier runs are kept so that a run which only fetches
+    new messages can still write complete month sheets and balances.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"accounts": {}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.data = json.load(f)
+
+    def _account(self, account):
+        return self.data["accounts"].setdefault(account, {"history_id": None, "transactions": {}})
+
+    def get_history_id(self, account):
+        return self._account(account).get("history_id")
+
+    def set_history_id(self, account, history_id):
+        self._account(account)["history_id"] = history_id
+
+    def get_transactions(self, account, issuer):
+        return list(self._account(account)["transactions"].get(issuer, {}).values())
+
+    def add_transactions(self, account, issuer, transactions, replace=False):
+        """Record transactions (see transaction_key); `replace` drops previously stored ones first."""
+        store = self._account(account)["transactions"]
+        if replace or issuer not in store:
+            store[issuer] = {}
+        for trx in transactions:
+            store[issuer][transaction_key(trx)] = trx
+
+    def prune(self, before):
+        """Forget stored transactions dated before `before` (YYYY-MM-DD)."""
+        for account in self.data["accounts"].values():
+            for issuer, store in account["transactions"].items():
+                account["transactions"][issuer] = {
+                    key: trx for key, trx in store.items() if trx["date"] >= before
+                }
+
+    def save(self):
+        # write atomically so an interrupted run never leaves a truncated checkpoint
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp, self.path)
+        logger.info("Saved sync state to %s", self.path)
@@ -0,0 +1,91 @@
+import base64
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveInterval:
+    """
+    Poll interval that drops to `minimum` seconds whenever a poll finds new mail
+    and doubles after every idle poll, up to `maximum`.
+    """
+
+    def __init__(self, minimum=30, maximum=900):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.seconds = minimum
+
+    def update(self, found_mail):
+        self.seconds = self.minimum if found_mail else min(self.maximum, self.seconds * 2)
+        return self.seconds
+
+
+def parse_push(body):
+    """
+    Return (email address, history id) from a Pub/Sub push request body carrying
+    a Gmail watch notification, or None if it isn't one.
+    """
+    try:
+        message = json.loads(body)["message"]
+        data = json.loads(base64.b64decode(message["data"]))
+        return data["emailAddress"], data.get("historyId")
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class _PushHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        listener = self.server.listener
+        url = urlsplit(self.path)
+        if listener.token and parse_qs(url.query).get("token", [None])[0] != listener.token:
+            self.send_response(403)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        notification = parse_push(self.rfile.read(length) if length else b"")
+        if notification:
+            listener.callback(*notification)
+        else:
+            logger.warning("Ignoring push request that is not a Gmail notification.")
+        # acknowledge either way, or Pub/Sub keeps redelivering it
+        self.send_response(204)
+        self.end_headers()
+
+
+class PushListener:
+    """
+    Local HTTP endpoint for a Pub/Sub push subscription to a Gmail `watch` topic.
+
+    Calls callback(email address, history id) for every notification. With a
+    `token`, requests must carry it as ?token=... in the push endpoint URL.
+    """
+
+    def __init__(self, callback, host="0.0.0.0", port=8080, token=None):
+        self.callback = callback
+        self.token = token
+        self.httpd = ThreadingHTTPServer((host, port), _PushHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.listener = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info("Listening for Gmail push notifications on %s", self.url)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,22 +1,41 @@
 import yaml
-import pandas as pd
 import os
+import argparse
+import csv
 import glob
 import logging
+import json
+import time
 from datetime import datetime, timedelta
 import importlib
-from collections import defaultdict
-import requests
-
-from mailmint.google.gmail import GMail
-from mailmint.google.gsheet import GSheet
-from mailmint.helpers import get_email_html
+import queue
+import signal
+import threading
+import sys
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Google client libraries and requests are imported inside the functions that use
+# them, so importing this module (e.g. from tools or benchmarks) stays fast.
+from mailmint.google.query import GmailQueryMatcher, combine_queries
+from mailmint.google.ratelimit import GMAIL_USER_QUOTA_PER_SECOND
+from mailmint.helpers import get_email_body
+from mailmint.state import SyncState
+from mailmint.cache import MessageCache
+from mailmint.aggregate import SHEET_COLUMNS, MonthAggregator
+from mailmint.categories import DEFAULT_CATEGORY, build_categorizer
+from mailmint.metrics import metrics
+from mailmint.dedup import MessageIndex, message_fingerprint, unique_transactions
+from mailmint.ledger import BalanceLedger
+from mailmint.sinks import SheetsSink, SQLiteSink
+from mailmint.backfill import BackfillCheckpoint, month_windows, parse_month, window_key
 
 def load_config():
     with open("config.yml", "r") as f:
         return yaml.safe_load(f)
 
-config = load_config()
+# populated by main(), so importing this module has no side effects
+config = {}
 
 # set up basic logging for discovery helper
 logging.basicConfig(level=logging.INFO)
@@ -41,35 +60,172 @@ def discover_token_pickles(script_dir=None, pattern="*.pickle"):
     picks.sort()
     return picks
 
-def build_gmail_clients_from_pickles(script_dir=None, pattern="*.pickle"):
+def load_profile(g, token_path):
+    """Return (email, history_id) for a GMail client.
+
+    The email address is cached next to the token in `<token>.profile.json` for
+    `profile_cache_days` (default 7), so repeat runs skip the getProfile call.
+    history_id is only known when getProfile was actually called, else None.
+    """
+    profile_path = token_path + ".profile.json"
+    if os.path.exists(profile_path):
+        try:
+            with open(profile_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            # e.g. left truncated by a crash; fetch the profile again, which rewrites it
+            logger.warning("Ignoring unreadable profile cache %s: %s", profile_path, e)
+            cached = None
+        if isinstance(cached, dict) and cached.get("email") and cached.get("expires_at", 0) > time.time():
+            return cached["email"], None
+
+    try:
+        metrics.api_call("getProfile")
+        profile = g.client.users().getProfile(userId="me").execute(http=g.http)
+    except Exception:
+        # token might be invalid/expired but client constructed; record None
+        return None, None
+
+    email = profile.get("emailAddress")
+    # write atomically, like SyncState
+    tmp = profile_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"email": email, "expires_at": time.time() + config.get("profile_cache_days", 7) * 86400}, f)
+    os.replace(tmp, profile_path)
+    return email, profile.get("historyId")
+
+def build_gmail_clients_from_pickles(script_dir=None, pattern="*.pickle", cache=None, dedup=None):
     """Discover pickle token files and instantiate a GMail client for each.
 
-    Returns a list of dicts: {"token": path, "client": GMail instance, "email": account email or None}
+    All clients share `dedup` (a MessageIndex), if given, so an email found in
+    several mailboxes is only fetched from one of them.
+
+    Tokens are loaded (and refreshed if needed) concurrently. Refreshed tokens are
+    written back to their pickle, and account emails are cached next to them (see
+    load_profile).
+
+    Returns a list of dicts: {"token": path, "client": GMail instance, "email": account email or None,
+    "history_id": mailbox historyId at load time or None}
     Invalid or un-authorisable token files are skipped with a warning.
     """
-    clients = []
+    from mailmint.google.gmail import GMail
+
     picks = discover_token_pickles(script_dir=script_dir, pattern=pattern)
     if not picks:
         logger.info("No token pickles found in %s", script_dir or get_script_dir())
-        return clients
+        return []
 
-    for p in picks:
+    def load(p):
         try:
-            g = GMail(creds="credentials.json", token=p)
-            # try to fetch profile email to verify token works
-            try:
-                profile = g.client.users().getProfile(userId="me").execute()
-                email = profile.get("emailAddress")
-            except Exception:
-                # token might be invalid/expired but client constructed; record None
-                email = None
-            clients.append({"token": p, "client": g, "email": email})
+            g = GMail(creds="credentials.json", token=p, cache=cache, dedup=dedup,
+                      quota_per_second=config.get("gmail_quota_per_second", GMAIL_USER_QUOTA_PER_SECOND))
+            email, history_id = load_profile(g, p)
             logger.info("Loaded token: %s (email=%s)", os.path.basename(p), email)
+            client_data = {"token": p, "client": g, "email": email, "history_id": history_id}
+            g.account = account_key(client_data)
+            return client_data
         except Exception as e:
             logger.warning("Skipping token %s: %s", p, str(e))
-            continue
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(picks)) as executor:
+        # map keeps the sorted token order
+        return [client for client in executor.map(load, picks) if client]
 
-    return clients
+def build_sheets_client(gmail_clients, token="token_gmail.pickle"):
+    """Return a GSheet client, reusing the credentials (and connections) of the
+    GMail client loaded from the same token when there is one."""
+    from mailmint.google.gsheet import GSheet
+
+    for client_data in gmail_clients:
+        if os.path.basename(client_data["token"]) == os.path.basename(token):
+            return GSheet(credentials=client_data["client"].credentials)
+    return GSheet(token=token)
+
+def account_key(client_data):
+    """Stable key identifying a mailbox in the sync state."""
+    return client_data["email"] or os.path.basename(client_data["token"])
+
+def prepare_incremental_sync(gmail_clients, state):
+    """Attach the set of message ids added since the last checkpoint to each client.
+
+    `new_ids` is None when there is no usable checkpoint and the client needs a
+    full window scan. `history_id`, the next checkpoint, is always taken before
+    any message is listed, so mail arriving while this run is in progress is
+    picked up again next time rather than missed.
+    """
+    for client_data in gmail_clients:
+        gmail_client = client_data["client"]
+        checkpoint = state.get_history_id(account_key(client_data))
+        new_ids = None
+        with metrics.scope(account=account_key(client_data)), metrics.timer("history"):
+            if checkpoint:
+                new_ids, history_id = gmail_client.get_added_message_ids(checkpoint)
+            if new_ids is None:
+                logger.info("%s: No usable sync checkpoint, scanning full window.", account_key(client_data))
+                history_id = client_data["history_id"] or gmail_client.get_history_id()
+            else:
+                logger.info("%s: %d message(s) added since history id %s.",
+                            account_key(client_data), len(new_ids), checkpoint)
+        client_data["new_ids"] = new_ids
+        client_data["history_id"] = history_id
+
+def metadata_prefilter(parser):
+    """The parser's metadata check if its issuer configures a `metadata_filter`, else None (single-phase fetch)."""
+    return parser.accepts_metadata if parser.metadata_filter else None
+
+def process_emails(client_data, issuers, parsers, after, cache=None, parse_pool=None, before=None):
+    """Worker: fetch and parse emails from one account, honouring the account's concurrency cap.
+
+    `issuers` maps issuer index -> issuer config. Messages received from `after`
+    up to `before` (if given) are fetched, see GMail.get_emails. A single issuer
+    is fetched with its own query; several are fetched with one combined query
+    and routed back locally. Messages are parsed as their batch arrives (on `parse_pool` if given)
+    and dropped right after, so only the resulting transactions are kept. Returns
+    a dict of issuer index -> list of transactions.
+    """
+    gmail_client = client_data["client"]
+    only_ids = client_data.get("new_ids")
+    transactions = {i: [] for i in issuers}
+    stats = {i: Counter() for i in issuers}
+    with client_data["semaphore"], metrics.scope(account=account_key(client_data)):
+        if len(issuers) == 1:
+            (i, issuer), = issuers.items()
+            routed = ((msg, [i]) for msg in gmail_client.iter_emails(
+                issuer["email_query"], after, only_ids=only_ids, prefilter=metadata_prefilter(parsers[i]), before=before))
+        else:
+            indices = list(issuers)
+            queries = [issuers[i]["email_query"] for i in indices]
+            prefilters = [metadata_prefilter(parsers[i]) for i in indices]
+            routed = ((msg, [indices[k] for k in hits])
+                      for msg, hits in gmail_client.iter_emails_for_queries(
+                          queries, after, only_ids=only_ids, prefilters=prefilters, before=before))
+
+        for i, transaction in parse_routed(routed, parsers, stats, cache, parse_pool, account_key(client_data)):
+            transactions[i].append(transaction)
+
+    for i in issuers:
+        log_parse_stats(parsers[i], stats[i], account_key(client_data))
+    return transactions
+
+def plan_fetches(issuers):
+    """Group issuers into fetch units: lists of {issuer index: issuer} fetched together.
+
+    With `combined_query` enabled, every issuer whose query can be routed locally
+    shares one unit; the rest are fetched on their own.
+    """
+    units = []
+    combined = {}
+    for i, issuer in enumerate(issuers):
+        if config.get("combined_query", False) and GmailQueryMatcher(issuer["email_query"]).routable:
+            combined[i] = issuer
+        else:
+            units.append({i: issuer})
+    if len(combined) > 1:
+        units.insert(0, combined)
+    elif combined:
+        units.append(combined)
+    return units
 
 def import_class(full_class_path):
     """
@@ -81,6 +237,8 @@ def import_class(full_class_path):
     return getattr(module, class_name)
 
 def get_parser_for_issuer(issuer_config):
+    # copy, so config keeps parser_class for parse pool workers building their own parsers
+    issuer_config = dict(issuer_config)
     parser_path = issuer_config.pop("parser_class", "mailmint.issuers.base.BaseIssuerParser")
     if not parser_path:
         raise ValueError(f"No 'parser_class' provided in config for issuer: {issuer_config.get('name')}")
@@ -93,62 +251,334 @@ def dump_email(msg, body):
     open(fname, "w").write(body)
     return fname
 
-def extract_transactions(messages, parser):
+def build_cache():
+    """Return a MessageCache configured by the optional `cache` config section, or None."""
+    cache_config = config.get("cache")
+    if not cache_config:
+        return None
+    if not isinstance(cache_config, dict):
+        cache_config = {}
+    return MessageCache(
+        path=cache_config.get("path", os.path.join(get_script_dir(), "cache.sqlite")),
+        max_age_days=cache_config.get("max_age_days", 90),
+        max_size_mb=cache_config.get("max_size_mb", 512),
+    )
+
+def build_dedup_index():
+    """Return a MessageIndex shared by all accounts if `dedup` is enabled, else None."""
+    return MessageIndex() if config.get("dedup", False) else None
+
+def fetch_scopes(issuers):
+    """Issuer index -> the Gmail query its fetch unit lists messages with (see process_emails), i.e. its dedup scope."""
+    scopes = {}
+    for unit in plan_fetches(issuers):
+        queries = [issuers[i]["email_query"] for i in unit]
+        scope = queries[0] if len(queries) == 1 else combine_queries(queries)
+        scopes.update((i, scope) for i in unit)
+    return scopes
+
+def seed_dedup_index(dedup, held):
+    """Claim the emails accounts already hold for them, from (account, issuer index, transactions) triples.
+
+    Run before fetching, so an account doing a full scan doesn't re-add emails that
+    another account kept from an earlier run (in the sync state or a backfill checkpoint).
+    """
+    scopes = fetch_scopes(config["issuers"])
+    seeded = 0
+    for account, i, transactions in held:
+        for trx in transactions:
+            if trx.get("fingerprint"):
+                dedup.seed(scopes[i], trx["fingerprint"], account)
+                seeded += 1
+    logger.info("Seeded the dedup index with %d email(s) kept from earlier runs.", seeded)
+
+def held_in_state(state, gmail_clients, parsers):
+    """(account, issuer index, transactions) triples of what `state` keeps, for seed_dedup_index."""
+    for client_data in gmail_clients:
+        for i, parser in enumerate(parsers):
+            yield account_key(client_data), i, state.get_transactions(account_key(client_data), parser.name)
+
+def dedupe(transactions):
+    """With `dedup` enabled, drop transactions of an issuer whose email another account already holds."""
+    return unique_transactions(transactions) if config.get("dedup", False) else transactions
+
+def extract_transactions(messages, parser, cache=None):
+    """Parse an iterable of messages into a list of transactions."""
     transactions = []
-
-    skipped = 0
+    stats = Counter()
 
     for msg in messages:
-        html_body = get_email_html(msg)
-        if config.get("debug", False):
-            fname = dump_email(msg, html_body)
-            logger.debug("Email written to (debug mode): %s", fname)
-
-        required_keywords = ["inr", "rs."]
-        if not any(kw.lower() in html_body.lower() for kw in required_keywords):
-            skipped += 1
-            continue
+        transaction = parse_message(msg, parser, cache, stats)
+        if transaction:
+            transactions.append(transaction)
 
-        details = parser.parse_email_body(html_body, msg)
-        if not details:
-            fname = dump_email(msg, html_body)
-            logger.warning("No transaction details found in: %s", fname)
-            continue
+    log_parse_stats(parser, stats)
+    return transactions
 
-        email_date = datetime.fromtimestamp(int(msg["internalDate"]) / 1000)
-        category = "Uncategorized"
-        transaction = {
-            "date": email_date.strftime("%Y-%m-%d"),
-            "account": details.get("account"),
-            "merchant": details.get("merchant"),
-            "amount": details.get("amount"),
-            "category": category
-        }
-        logger.info("Parsed transaction: %s", transaction)
-        transactions.append(transaction)
+def log_parse_stats(parser, stats, account=None):
+    source = f" from {account}" if account else ""
+    logger.info("%s: Parsed %d emails%s.", parser.name, stats["messages"], source)
+    logger.info("%s: Skipped %d emails without required keywords.", parser.name, stats["skipped"])
+    if stats["cached"]:
+        logger.info("%s: Reused %d cached parse results.", parser.name, stats["cached"])
 
-    logger.info("%s: Skipped %d emails without required keywords.", parser.name, skipped)
+def parse_message(msg, parser, cache=None, stats=None):
+    """Parse one message into a transaction dict, or None if it isn't one.
 
-    return transactions
+    `stats` is an optional Counter updated with messages/skipped/cached counts.
+    """
+    stats = stats if stats is not None else Counter()
+    found, transaction = cached_parse(msg, parser, cache, stats)
+    if found:
+        return transaction
+
+    status, transaction = parse_payload(msg, parser)
+    record_parse(msg["id"], parser, status, transaction, cache, stats)
+    return transaction
+
+def cached_parse(msg, parser, cache, stats):
+    """Count the message and look up its cached parse result. Returns (found, transaction)."""
+    stats["messages"] += 1
+    if cache:
+        found, transaction = cache.get_parse(msg["id"], parser.config_hash)
+        if found:
+            if transaction and "fingerprint" not in transaction:
+                # cached before transactions carried one
+                transaction["fingerprint"] = message_fingerprint(msg)
+            stats["cached"] += 1
+            metrics.inc("parse_results_total", issuer=parser.name, result="cached")
+            return True, transaction
+    return False, None
+
+def parse_payload(msg, parser):
+    """Decode and parse one message. Returns (status, transaction or None), status being
+    "transaction", "skipped" (no required keywords) or "no_details".
+
+    Only needs the message and the parser, so it can run in a parse pool worker.
+    """
+    with metrics.timer("decode"):
+        html_body = get_email_body(msg, parser.body_type)
+    if config.get("debug", False):
+        fname = dump_email(msg, html_body)
+        logger.debug("Email written to (debug mode): %s", fname)
+
+    with metrics.timer("parse", issuer=parser.name):
+        relevant = parser.has_required_keywords(html_body, msg)
+        details = parser.parse_email_body(html_body, msg) if relevant else None
+
+    if not relevant:
+        return "skipped", None
+
+    if not details:
+        fname = dump_email(msg, html_body)
+        logger.warning("No transaction details found in: %s", fname)
+        return "no_details", None
+
+    email_date = datetime.fromtimestamp(int(msg["internalDate"]) / 1000)
+    category = DEFAULT_CATEGORY
+    transaction = {
+        "id": msg.get("id"),
+        "fingerprint": message_fingerprint(msg),
+        "date": email_date.strftime("%Y-%m-%d"),
+        "account": details.get("account"),
+        "merchant": details.get("merchant"),
+        "amount": details.get("amount"),
+        "category": category
+    }
+    logger.info("Parsed transaction: %s", transaction)
+    return "transaction", transaction
+
+def record_parse(msg_id, parser, status, transaction, cache, stats):
+    """Count a parse_payload result and cache it."""
+    metrics.inc("parse_results_total", issuer=parser.name, result=status)
+    if status == "skipped":
+        stats["skipped"] += 1
+    # "no_details" is not cached, so the warning (and the dump) repeats until the parser is fixed
+    if cache and status != "no_details":
+        cache.put_parse(msg_id, parser.config_hash, transaction)
+
+# parsers of a parse pool worker process, built by init_parse_worker
+worker_parsers = None
+
+def init_parse_worker(worker_config, log_level):
+    """Parse pool initializer: adopt the parent's config and log level, and build this process's own parsers."""
+    global worker_parsers
+    logging.getLogger().setLevel(log_level)
+    config.update(worker_config)
+    worker_parsers = [get_parser_for_issuer(issuer) for issuer in config["issuers"]]
+
+def parse_chunk(items, account=None):
+    """Parse pool task: parse [(issuer index, msg)] into [(status, transaction)], plus the chunk's metrics."""
+    metrics.reset()
+    with metrics.scope(account=account):
+        results = [parse_payload(msg, worker_parsers[i]) for i, msg in items]
+    return results, metrics.report()
+
+def start_parse_pool(processes):
+    """Process pool parsing messages for the issuers in config, see parse_routed."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # spawn rather than fork: forking while fetch threads hold locks can deadlock the child
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_parse_worker,
+                               initargs=(dict(config), logging.getLogger().getEffectiveLevel()))
+
+def parse_routed(routed, parsers, stats, cache=None, pool=None, account=None):
+    """
+    Parse (msg, issuer indices) pairs and yield (issuer index, transaction) for
+    every transaction found, in input order.
+
+    With a parse `pool` (see start_parse_pool), cache lookups stay in this process
+    and the remaining messages go to the workers in chunks of `parse_chunk_size`
+    (default 100). Only (status, transaction) pairs come back. At most two chunks
+    per worker process are in flight, so a fast fetch can't pile messages up.
+    """
+    if pool is None:
+        for msg, hits in routed:
+            for i in hits:
+                transaction = parse_message(msg, parsers[i], cache, stats[i])
+                if transaction:
+                    yield i, transaction
+        return
+
+    chunk_size = config.get("parse_chunk_size", 100)
+    max_pending = 2 * config.get("parse_processes", 1)
+    pending = deque()
+    chunk = []  # (issuer index, msg or None if its result was cached, cached transaction)
+
+    def submit():
+        items = [(i, msg) for i, msg, _ in chunk if msg is not None]
+        future = pool.submit(parse_chunk, items, account) if items else None
+        pending.append(([(i, msg and msg["id"], transaction) for i, msg, transaction in chunk], future))
+        chunk.clear()
+
+    def collect():
+        entries, future = pending.popleft()
+        results = iter(())
+        if future:
+            results, report = future.result()
+            metrics.merge(report)
+            results = iter(results)
+        for i, msg_id, transaction in entries:
+            if msg_id is not None:
+                status, transaction = next(results)
+                record_parse(msg_id, parsers[i], status, transaction, cache, stats[i])
+            if transaction:
+                yield i, transaction
+
+    for msg, hits in routed:
+        for i in hits:
+            found, transaction = cached_parse(msg, parsers[i], cache, stats[i])
+            chunk.append((i, None if found else msg, transaction))
+        if len(chunk) >= chunk_size:
+            submit()
+            while len(pending) > max_pending:
+                yield from collect()
+    if chunk:
+        submit()
+    while pending:
+        yield from collect()
+
+def window_start(now):
+    """Start of the window a run covers: the first day of the previous calendar month, i.e. the last 2 calendar months."""
+    return (now.replace(day=1) - timedelta(days=1)).replace(day=1)
+
+def build_ledger():
+    """Return the BalanceLedger kept in `ledger_file` (default ledger.json next to main.py)."""
+    return BalanceLedger(config.get("ledger_file", os.path.join(get_script_dir(), "ledger.json")))
+
+def notify_balances(ledger, now):
+    """Send the ledger's balances to Pushover if any changed since they were last sent, and save the ledger."""
+    # report balances for all accounts and transactions uptil yesterday
+    # to handle edge case of when the new month starts
+    month = (now - timedelta(days=1)).strftime("%Y-%m")
+    ledger.prune(window_start(now).strftime("%Y-%m"))
+    balances = ledger.changed(month)
+    if balances:
+        for acc, bal in balances.items():
+            logger.info("Account balance for %s: %.2f", acc, bal)
+        with metrics.timer("notify"):
+            if pushover(balances):
+                ledger.mark_notified(month, balances)
+    elif ledger.balances(month):
+        logger.info("Account balances unchanged since the last notification.")
+    else:
+        logger.info("No account balances to send.")
+    ledger.save()
+
+def build_sinks(gmail_clients):
+    """Return the outputs listed in the optional `sinks` config section, by default just the Google spreadsheet."""
+    sinks = []
+    for sink_config in config.get("sinks") or [{"type": "sheets"}]:
+        sink_config = dict(sink_config)
+        kind = sink_config.pop("type", None)
+        if kind == "sheets":
+            sinks.append(SheetsSink(build_sheets_client(gmail_clients), config["spreadsheet_id"], **sink_config))
+        elif kind == "sqlite":
+            sink_config.setdefault("path", os.path.join(get_script_dir(), "transactions.sqlite"))
+            sinks.append(SQLiteSink(**sink_config))
+        else:
+            raise ValueError(f"Unknown sink type '{kind}', expected 'sheets' or 'sqlite'")
+    return sinks
+
+def write_sinks(sinks, months):
+    """Hand every month of `months` (a MonthAggregator, see MonthAggregator.records) to every sink."""
+    for month, records in months.records():
+        logger.info("Prepared sheet data for month %s with %d transactions.", month, len(records))
+        for sink in sinks:
+            sink.write({month: records})
+
+def close_sinks(sinks):
+    """Flush what the sinks still buffer and close them."""
+    for sink in sinks:
+        sink.close()
+
+def build_store():
+    """Return the SQLiteSink configured in `sinks`, else one on the default path."""
+    for sink_config in config.get("sinks") or []:
+        if sink_config.get("type") == "sqlite":
+            return SQLiteSink(sink_config.get("path", os.path.join(get_script_dir(), "transactions.sqlite")))
+    return SQLiteSink(os.path.join(get_script_dir(), "transactions.sqlite"))
+
+def export(first_month=None, last_month=None, to_csv=False):
+    """Re-export the months first_month..last_month (datetimes, see parse_month) of the
+    local store, to the spreadsheet or as CSV on stdout."""
+    store = build_store()
+    months = store.read(first_month and first_month.strftime("%Y-%m"), last_month and last_month.strftime("%Y-%m"))
+    if to_csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["month", *SHEET_COLUMNS])
+        for month, records in months:
+            writer.writerows([month, *row] for _, row in records)
+    else:
+        sink = SheetsSink(build_sheets_client([]), config["spreadsheet_id"])
+        for month, records in months:
+            logger.info("Exporting %d transactions of month %s.", len(records), month)
+            sink.write({month: records})
+        sink.close()
+    store.close()
+    export_metrics()
 
 def prepare_transaction_sheets(transactions):
+    """Yield (month, rows) sheet data from a MonthAggregator or an iterable of transactions."""
+    if not isinstance(transactions, MonthAggregator):
+        transactions = MonthAggregator(transactions)
     if not transactions:
         logger.info("No transactions found.")
-        return []
+        return
 
-    df = pd.DataFrame(transactions)
-    df["month"] = df["date"].str[:7]  # YYYY-MM
+    yield from transactions.sheets()
 
-    sheets_data = []
-    for month, group in df.groupby("month"):
-        group = group.sort_values("date")
-        values = group[["date", "amount", "merchant", "account", "category"]].values.tolist()
-        yield month, values
+# one keep-alive session for every Pushover request of the process
+pushover_session = None
 
 def pushover(account_balances):
+    """Send all balances in one message. Returns True if Pushover accepted it."""
+    global pushover_session
     if not account_balances:
         logger.info("No account balances to send.")
-        return
+        return False
 
     total = sum(account_balances.values())
     message = f"<b>Total: ₹{total:,.2f}</b>" + "\n" + "\n".join(f"{acc}: ₹{bal:,.2f}" for acc, bal in account_balances.items())
@@ -159,58 +589,396 @@ def pushover(account_balances):
 
     if not user or not token:
         logger.warning("Pushover credentials not configured. Skipping notification.")
-        return
+        return False
+
+    import requests
+    if pushover_session is None:
+        pushover_session = requests.Session()
+    try:
+        response = pushover_session.post("https://api.pushover.net/1/messages.json", params={'html': 1}, data={
+            "token": token,
+            "user": user,
+            "message": message,
+        }, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning("Pushover notification failed, will retry next time: %s", e)
+        return False
+    return True
+
+def export_metrics():
+    """Write the run's metrics to the files named in the optional `metrics` config section."""
+    metrics_config = config.get("metrics") or {}
+    totals = defaultdict(float)
+    for stage in metrics.report()["stages"]:
+        totals[stage["stage"]] += stage["seconds"]
+    logger.info("Time per stage: %s", ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in totals.items()))
+    if metrics_config.get("json"):
+        metrics.write_json(metrics_config["json"])
+        logger.info("Metrics report written to %s", metrics_config["json"])
+    if metrics_config.get("prometheus"):
+        metrics.write_prometheus(metrics_config["prometheus"])
+        logger.info("Prometheus metrics written to %s", metrics_config["prometheus"])
+
+def backfill(first_month, last_month, checkpoint_path, months_per_window=1):
+    """Import every transaction of the months first_month..last_month (datetimes, see parse_month).
+
+    The range is split into windows of `months_per_window` months. Each window is
+    fetched per (issuer, account) with after:/before: bounds, concurrently on
+    `workers` threads within the usual `per_account_workers` caps. Every finished window is
+    saved to the checkpoint, so re-running the same command after an interruption
+    only fetches the windows still missing. Month sheets are written once all
+    windows are done.
+    """
+    cache = build_cache()
+    dedup = build_dedup_index()
+    gmail_clients = build_gmail_clients_from_pickles(cache=cache, dedup=dedup)
+    sinks = build_sinks(gmail_clients)
+    checkpoint = BackfillCheckpoint(checkpoint_path)
+    windows = month_windows(first_month, last_month, months_per_window)
+
+    per_account_workers = config.get("per_account_workers", 2)
+    for client_data in gmail_clients:
+        client_data["semaphore"] = threading.BoundedSemaphore(per_account_workers)
+
+    parsers = [get_parser_for_issuer(issuer) for issuer in config["issuers"]]
+    if dedup:
+        seed_dedup_index(dedup, ((account_key(client_data), i, checkpoint.get(
+            window_key(account_key(client_data), parser.name, start, end)))
+            for start, end in windows for i, parser in enumerate(parsers) for client_data in gmail_clients))
+    parse_pool = start_parse_pool(config["parse_processes"]) if config.get("parse_processes") else None
+    executor = ThreadPoolExecutor(max_workers=config.get("workers", 1))
+    futures = {}
+    finished = 0
+    for start, end in windows:
+        for unit in plan_fetches(config["issuers"]):
+            for client_data in gmail_clients:
+                todo = {i: issuer for i, issuer in unit.items()
+                        if not checkpoint.done(window_key(account_key(client_data), parsers[i].name, start, end))}
+                finished += len(unit) - len(todo)
+                if todo:
+                    future = executor.submit(process_emails, client_data, todo, parsers, int(start.timestamp()),
+                                             cache, parse_pool, int(end.timestamp()))
+                    futures[future] = (client_data, start, end)
+    logger.info("Backfill of %d window(s): %d (issuer, account) window(s) already done, %d fetch(es) to run.",
+                len(windows), finished, len(futures))
+
+    failed = 0
+    for future in as_completed(futures):
+        client_data, start, end = futures[future]
+        try:
+            result = future.result()
+        except Exception:
+            failed += 1
+            logger.exception("%s: Backfill window from %s failed.", account_key(client_data), start.strftime("%Y-%m-%d"))
+            continue
+        for i, transactions in result.items():
+            checkpoint.add(window_key(account_key(client_data), parsers[i].name, start, end), transactions)
+        logger.info("%s: Backfilled window from %s.", account_key(client_data), start.strftime("%Y-%m-%d"))
+
+    executor.shutdown()
+    if parse_pool:
+        parse_pool.shutdown()
+
+    if failed:
+        logger.error("%d backfill window(s) failed, not writing sheets. Re-run to retry them.", failed)
+    else:
+        months = MonthAggregator(categorize=build_categorizer(config.get("categories")))
+        for parser in parsers:
+            months.extend(dedupe([trx for start, end in windows for client_data in gmail_clients
+                                  for trx in checkpoint.get(window_key(account_key(client_data), parser.name, start, end))]))
+        write_sinks(sinks, months)
+        metrics.inc("transactions_total", len(months))
+    close_sinks(sinks)
+
+    if cache:
+        cache.evict()
+        cache.close()
+    export_metrics()
+
+def sync_mailboxes(gmail_clients, parsers, state, after, executor, cache=None, parse_pool=None):
+    """Fetch and parse what each client needs since its checkpoint into `state`, see prepare_incremental_sync.
+
+    Clients without `new_ids` get a full scan of the window from `after`, which
+    replaces what `state` knew about them. Returns the number of transactions found.
+    """
+    futures = [(client_data, executor.submit(process_emails, client_data, unit, parsers, after, cache, parse_pool))
+               for unit in plan_fetches(config["issuers"]) for client_data in gmail_clients]
+    found = 0
+    for client_data, future in futures:
+        for i, transactions in future.result().items():
+            state.add_transactions(account_key(client_data), parsers[i].name, transactions,
+                                   replace=client_data["new_ids"] is None)
+            found += len(transactions)
+    for client_data in gmail_clients:
+        state.set_history_id(account_key(client_data), client_data["history_id"])
+    return found
+
+def flush_from_state(sinks, gmail_clients, parsers, state, ledger, categorize=None):
+    """Write the month sheets from every transaction in `state` and send changed balances, then save it."""
+    now = datetime.now()
+    months = MonthAggregator(categorize=categorize)
+    for issuer, parser in zip(config["issuers"], parsers):
+        transactions = dedupe([trx for client_data in gmail_clients
+                               for trx in state.get_transactions(account_key(client_data), parser.name)])
+        months.extend(transactions)
+        ledger.add(issuer, transactions)
+
+    write_sinks(sinks, months)
+    for sink in sinks:
+        sink.flush()
+    notify_balances(ledger, now)
+    state.save()
+    export_metrics()
+
+def watch():
+    """Run as a daemon, keeping clients, parsers and pools warm between syncs.
+
+    An account is synced from its history checkpoint whenever a Gmail push
+    notification for it arrives (with `watch.topic` set, see PushListener) and at
+    least every poll interval, which adapts between `watch.poll_min_seconds` and
+    `watch.poll_max_seconds`. New transactions are kept in the sync state; sheet
+    writes and balance notifications are coalesced into one flush at most every
+    `watch.flush_seconds`. Stops on SIGINT/SIGTERM after a final flush.
+    """
+    # http.server is only needed by the daemon, keep it out of cron runs
+    from mailmint.watch import AdaptiveInterval, PushListener
+
+    watch_config = config.get("watch") or {}
+    cache = build_cache()
+    dedup = build_dedup_index()
+    gmail_clients = build_gmail_clients_from_pickles(cache=cache, dedup=dedup)
+    sinks = build_sinks(gmail_clients)
+    state = SyncState(config.get("state_file", os.path.join(get_script_dir(), "state.json")))
+    accounts = {account_key(client_data): client_data for client_data in gmail_clients}
+
+    per_account_workers = config.get("per_account_workers", 2)
+    for client_data in gmail_clients:
+        client_data["semaphore"] = threading.BoundedSemaphore(per_account_workers)
+    parsers = [get_parser_for_issuer(issuer) for issuer in config["issuers"]]
+    if dedup:
+        seed_dedup_index(dedup, held_in_state(state, gmail_clients, parsers))
+    categorize = build_categorizer(config.get("categories"))
+    ledger = build_ledger()
+    parse_pool = start_parse_pool(config["parse_processes"]) if config.get("parse_processes") else None
+    executor = ThreadPoolExecutor(max_workers=config.get("workers", 1))
+
+    # account keys to sync, None asks the loop to stop
+    events = queue.Queue()
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+        events.put(None)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    listener = None
+    topic = watch_config.get("topic")
+    if topic:
+        emails = {client_data["email"]: key for key, client_data in accounts.items() if client_data["email"]}
+
+        def on_push(email, history_id):
+            if email in emails:
+                events.put(emails[email])
+            else:
+                logger.warning("Push notification for unknown account %s.", email)
+        host, _, port = watch_config.get("listen", "0.0.0.0:8080").rpartition(":")
+        listener = PushListener(on_push, host or "0.0.0.0", int(port), watch_config.get("token")).start()
+
+    interval = AdaptiveInterval(watch_config.get("poll_min_seconds", 30), watch_config.get("poll_max_seconds", 900))
+    flush_seconds = watch_config.get("flush_seconds", 15)
+    pending = set(accounts)  # sync everything on start-up
+    dirty = False
+    last_flush = next_poll = renew_at = evict_at = time.monotonic()
+    while not stopping.is_set():
+        if topic and time.monotonic() >= renew_at:
+            # watches expire after 7 days, renew daily
+            for key, client_data in accounts.items():
+                try:
+                    client_data["client"].watch(topic, watch_config.get("label_ids"))
+                except Exception:
+                    logger.exception("%s: Could not start Gmail watch, relying on polling.", key)
+            renew_at = time.monotonic() + 86400
+
+        if cache and time.monotonic() >= evict_at:
+            cache.evict()
+            evict_at = time.monotonic() + 86400
+
+        if pending:
+            clients = [accounts[key] for key in sorted(pending)]
+            pending.clear()
+            try:
+                after_date = window_start(datetime.now())
+                state.prune(after_date.strftime("%Y-%m-%d"))
+                prepare_incremental_sync(clients, state)
+                found = sync_mailboxes(clients, parsers, state, after_date.strftime("%Y/%m/%d"), executor,
+                                       cache, parse_pool)
+            except Exception:
+                logger.exception("Sync failed, retrying at the next poll.")
+            else:
+                for client_data in clients:
+                    # saved as the checkpoint; the next sync must take a fresh one
+                    client_data["history_id"] = None
+                new_mail = any(client_data["new_ids"] is None or client_data["new_ids"] for client_data in clients)
+                dirty = dirty or new_mail
+                logger.info("Synced %d account(s): %d transaction(s).", len(clients), found)
+                next_poll = time.monotonic() + interval.update(new_mail)
+
+        if dirty and time.monotonic() - last_flush >= flush_seconds:
+            try:
+                flush_from_state(sinks, gmail_clients, parsers, state, ledger, categorize)
+                dirty = False
+            except Exception:
+                logger.exception("Flush failed, retrying later.")
+            last_flush = time.monotonic()
 
-    requests.post("https://api.pushover.net/1/messages.json", params={'html': 1}, data={
-        "token": token,
-        "user": user,
-        "message": message,
-    })
+        deadlines = [next_poll] + ([last_flush + flush_seconds] if dirty else []) + ([renew_at] if topic else [])
+        if cache:
+            deadlines.append(evict_at)
+        try:
+            key = events.get(timeout=max(0, min(deadlines) - time.monotonic()))
+        except queue.Empty:
+            if time.monotonic() >= next_poll:
+                pending.update(accounts)
+            continue
+        # coalesce notifications that arrived meanwhile into one sync
+        while key is not None:
+            pending.add(key)
+            try:
+                key = events.get_nowait()
+            except queue.Empty:
+                break
+
+    logger.info("Stopping.")
+    if listener:
+        listener.stop()
+    if dirty:
+        flush_from_state(sinks, gmail_clients, parsers, state, ledger, categorize)
+    else:
+        state.save()
+    close_sinks(sinks)
+    executor.shutdown()
+    if parse_pool:
+        parse_pool.shutdown()
+    if cache:
+        cache.evict()
+        cache.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract transactions from Gmail alerts into Google Sheets.")
+    commands = parser.add_subparsers(dest="command")
+    backfill_parser = commands.add_parser(
+        "backfill", help="import whole months of history, resumably",
+        description="Import all transactions of a range of months. Interrupted runs resume from --checkpoint.")
+    backfill_parser.add_argument("--from", dest="first_month", type=parse_month, required=True, help="first month, YYYY-MM")
+    backfill_parser.add_argument("--to", dest="last_month", type=parse_month, required=True, help="last month, YYYY-MM")
+    backfill_parser.add_argument("--checkpoint", help="file recording finished windows (default: backfill.jsonl next to main.py)")
+    backfill_parser.add_argument("--months-per-window", type=int, default=1, help="months fetched per window (default 1)")
+    commands.add_parser(
+        "watch", help="run as a daemon, syncing as new mail arrives",
+        description="Keep clients warm and sync on Gmail push notifications or an adaptive poll interval. "
+                    "Configured by the `watch` section of config.yml.")
+    export_parser = commands.add_parser(
+        "export", help="re-export months from the local SQLite store",
+        description="Write months kept by the `sqlite` sink to the spreadsheet, or as CSV to stdout.")
+    export_parser.add_argument("--from", dest="first_month", type=parse_month, help="first month, YYYY-MM (default: oldest)")
+    export_parser.add_argument("--to", dest="last_month", type=parse_month, help="last month, YYYY-MM (default: newest)")
+    export_parser.add_argument("--csv", action="store_true", help="write CSV to stdout instead of the spreadsheet")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics.reset()
+    config.update(load_config())
+    if args.command == "backfill":
+        checkpoint = args.checkpoint or os.path.join(get_script_dir(), "backfill.jsonl")
+        backfill(args.first_month, args.last_month, checkpoint, args.months_per_window)
+        return
+    if args.command == "watch":
+        watch()
+        return
+    if args.command == "export":
+        export(args.first_month, args.last_month, args.csv)
+        return
 
-def main():
-    sheets_client = GSheet()
-    gmail_clients = build_gmail_clients_from_pickles()
+    cache = build_cache()
+    dedup = build_dedup_index()
+    gmail_clients = build_gmail_clients_from_pickles(cache=cache, dedup=dedup)
+    sinks = build_sinks(gmail_clients)
 
     now = datetime.now()
-    # last 2 calendar months
-    after = (now.replace(day=1) - timedelta(days=1)).replace(day=1).strftime("%Y/%m/%d")
+    after_date = window_start(now)
+    after = after_date.strftime("%Y/%m/%d")
+
+    state = None
+    if config.get("incremental", False):
+        state = SyncState(config.get("state_file", os.path.join(get_script_dir(), "state.json")))
+        state.prune(after_date.strftime("%Y-%m-%d"))
+        prepare_incremental_sync(gmail_clients, state)
+
+    # Fetch and parse every (issuer, account) pair on a thread pool. Each account gets its own
+    # semaphore so that no more than `per_account_workers` requests hit one mailbox
+    # at a time, keeping us inside Gmail's per-user quota. Results are consumed
+    # in config order, so parsing and output stay deterministic.
+    per_account_workers = config.get("per_account_workers", 2)
+    for client_data in gmail_clients:
+        client_data["semaphore"] = threading.BoundedSemaphore(per_account_workers)
+
+    parsers = [get_parser_for_issuer(issuer) for issuer in config["issuers"]]
+    if dedup and state:
+        seed_dedup_index(dedup, held_in_state(state, gmail_clients, parsers))
+    # CPU-bound parsing moves to worker processes when `parse_processes` is set
+    parse_pool = start_parse_pool(config["parse_processes"]) if config.get("parse_processes") else None
+    executor = ThreadPoolExecutor(max_workers=config.get("workers", 1))
+    futures = {}
+    for unit in plan_fetches(config["issuers"]):
+        for j, client_data in enumerate(gmail_clients):
+            future = executor.submit(process_emails, client_data, unit, parsers, after, cache, parse_pool)
+            for i in unit:
+                futures[(i, j)] = future
+
+    months = MonthAggregator(categorize=build_categorizer(config.get("categories")))
+    ledger = build_ledger()
+    for i, issuer in enumerate(config["issuers"]):
+        parser = parsers[i]
+
+        transactions = []
+        for j, client_data in enumerate(gmail_clients):
+            new_ids = client_data.get("new_ids")
+            account_transactions = futures.pop((i, j)).result()[i]
+            if state:
+                # a full scan replaces what we knew about this account, an incremental one adds to it
+                state.add_transactions(account_key(client_data), parser.name, account_transactions, replace=new_ids is None)
+                account_transactions = state.get_transactions(account_key(client_data), parser.name)
+            transactions.extend(account_transactions)
+
+        transactions = dedupe(transactions)
+        months.extend(transactions)
+        logger.info("%s: Extracted %d transactions.", issuer.get("name"), len(transactions))
+        ledger.add(issuer, transactions)
 
-    all_transactions = []
-    account_balances = defaultdict(float)
-    for issuer in config["issuers"]:
-        parser = get_parser_for_issuer(issuer)
+    executor.shutdown()
+    if parse_pool:
+        parse_pool.shutdown()
 
-        messages = []
-        for client_data in gmail_clients:
-            gmail_client = client_data["client"]
-            messages.extend(gmail_client.get_emails(issuer["email_query"], after))
+    write_sinks(sinks, months)
+    close_sinks(sinks)
 
-        logger.info("%s: Parsing %d emails.", issuer.get("name"), len(messages))
+    notify_balances(ledger, now)
 
-        transactions = extract_transactions(messages, parser)
-        all_transactions.extend(transactions)
-        logger.info("%s: Extracted %d transactions.", issuer.get("name"), len(transactions))
+    if cache:
+        cache.evict()
+        cache.close()
+
+    if state:
+        for client_data in gmail_clients:
+            if client_data["history_id"]:
+                state.set_history_id(account_key(client_data), client_data["history_id"])
+        state.save()
 
-        if issuer.get("notify_balance", False) and transactions:
-            # report balances for all accounts and transactions uptil yesterday
-            # to handle edge case of when the new month starts
-            yesterday_month = (now - timedelta(days=1)).strftime("%Y-%m")
-            for trx in transactions:
-                if trx["date"][:7] == yesterday_month:
-                    if any(excl in trx["merchant"].lower() for excl in issuer.get("notify_exclude_merchants", [])):
-                        logger.info("Excluding merchant '%s' from balance calculation for account %s.", trx["merchant"], trx["account"])
-                        continue
-                    account_balances[trx["account"]] += trx["amount"]
-
-    for month, transactions in prepare_transaction_sheets(all_transactions):
-        logger.info("Prepared sheet data for month %s with %d transactions.", month, len(transactions))
-        sheets_client.write_to_spreadsheet(config["spreadsheet_id"], month, transactions)
-
-    for acc, bal in account_balances.items():
-        account_balances[acc] = -bal  # negate to show positive balance if net debits exceed credits
-        logger.info("Account balance for %s: %.2f", acc, account_balances[acc])
-
-    pushover(account_balances)
+    metrics.inc("transactions_total", len(months))
+    export_metrics()
 
 if __name__ == "__main__":
     main()